@@ -5,16 +5,31 @@ Backend Flask para registrar aperturas de emails y mostrar dashboard
 Soporta PostgreSQL (producción) y SQLite (desarrollo)
 """
 
-from flask import Flask, request, send_file, render_template, jsonify
+from flask import Flask, Response, request, send_file, render_template, jsonify, redirect, abort
 from flask_cors import CORS
-from datetime import datetime
+from datetime import datetime, timezone
+import atexit
 import io
+import json
 import os
+import secrets
+import threading
+import time
 import smtplib
 import ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import tracking_ids
+from live_counters import LiveCounters
+from repository import OPEN_COLUMNS, CLICK_COLUMNS, is_production
+from sharding import ShardedRepository, ShardWriteError, build_repository
+
 app = Flask(__name__)
 CORS(app)
 
@@ -25,88 +40,442 @@ SENDER_EMAIL = "vicerrectorado@liceobys.edu.ec"
 APP_PASSWORD = "kppm abst dddy wago"
 RECIPIENT_EMAIL = "administracion@itseia.ai"
 
-# Detectar si estamos en producción (Render) o desarrollo (local)
+# Detectar si estamos en producción (Render) o desarrollo (local):
+# producción = PostgreSQL en DATABASE_URL o en algún shard de SHARDS
 DATABASE_URL = os.environ.get('DATABASE_URL')
-USE_POSTGRES = DATABASE_URL is not None
+USE_POSTGRES = is_production()
+
+# Escritura por lotes de eventos (aperturas y clicks)
+EVENT_FLUSH_SIZE = int(os.environ.get('EVENT_FLUSH_SIZE', 50))
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', 2.0))
+# Eventos retenidos por tabla si la base falla (los más antiguos se descartan)
+EVENT_MAX_PENDING = int(os.environ.get('EVENT_MAX_PENDING', 10000))
+
+# Tabla de links en memoria (token -> URL destino)
+LINKS_REFRESH_INTERVAL = float(os.environ.get('LINKS_REFRESH_INTERVAL', 60.0))
+# Mínimo entre recargas provocadas por tokens desconocidos
+LINKS_MISS_REFRESH_INTERVAL = float(os.environ.get('LINKS_MISS_REFRESH_INTERVAL', 5.0))
+# Crear links exige Authorization: Bearer <LINKS_TOKEN>; sin él, solo en desarrollo
+LINKS_TOKEN = os.environ.get('LINKS_TOKEN')
+
+# Ingesta masiva de webhooks de proveedores de email (ESP)
+INGEST_TOKEN = os.environ.get('INGEST_TOKEN')
+INGEST_MAX_EVENTS = int(os.environ.get('INGEST_MAX_EVENTS', 50000))
+# Tamaño máximo del body (bytes); se aplica a toda la app, la ingesta es el body más grande
+INGEST_MAX_BYTES = int(os.environ.get('INGEST_MAX_BYTES', 32 * 1024 * 1024))
+INGEST_EVENT_TYPES = ('open', 'click', 'bounce')
+# Largo máximo de los campos de texto opcionales de un evento
+INGEST_FIELD_LIMITS = {'provider': 50, 'url': 2048, 'ip': 200, 'user_agent': 1000}
+
+app.config['MAX_CONTENT_LENGTH'] = INGEST_MAX_BYTES
+
+# Segmento de memoria compartida de los contadores en vivo (uno por servicio)
+LIVE_COUNTERS_NAME = os.environ.get('LIVE_COUNTERS_NAME', 'itseia_live')
 
 if USE_POSTGRES:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
     print("🐘 Usando PostgreSQL")
 else:
-    import sqlite3
-    DATABASE = 'email_tracking.db'
     print("📁 Usando SQLite (desarrollo)")
 
-
-def get_db_connection():
-    """Obtiene conexión a la base de datos (PostgreSQL o SQLite)"""
-    if USE_POSTGRES:
-        return psycopg2.connect(DATABASE_URL, sslmode='require')
-    else:
-        return sqlite3.connect(DATABASE)
+# Un Repository, o un ShardedRepository si SHARDS está configurado
+repo = build_repository(DATABASE_URL, sqlite_path='email_tracking.db')
+if isinstance(repo, ShardedRepository):
+    print(f"🧩 {len(repo.shards)} shards: {', '.join(repo.names)}")
 
 
 def init_db():
     """Inicializa la base de datos"""
-    if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS email_opens (
-                id SERIAL PRIMARY KEY,
-                email_id TEXT NOT NULL,
-                institucion TEXT,
-                autoridad TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT,
-                user_agent TEXT
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS formulario_contacto (
-                id SERIAL PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                email TEXT NOT NULL,
-                institucion TEXT,
-                telefono TEXT,
-                dia TEXT,
-                horario TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        print("✅ PostgreSQL inicializado")
+    repo.init_schema()
+    print(f"✅ {'PostgreSQL' if USE_POSTGRES else 'SQLite'} inicializado")
+
+
+# Gunicorn no ejecuta __main__: el esquema y sus migraciones se aplican antes
+# del primer request de cada proceso; si la base no responde se reintenta luego
+SCHEMA_RETRY_INTERVAL = 30
+_esquema_listo = False
+_esquema_reintento = 0.0
+_esquema_lock = threading.Lock()
+
+
+@app.before_request
+def asegurar_esquema():
+    """Aplica esquema y migraciones (ensure_schema) una sola vez por proceso"""
+    global _esquema_listo, _esquema_reintento
+    if _esquema_listo or time.monotonic() < _esquema_reintento:
+        return
+    with _esquema_lock:
+        if _esquema_listo or time.monotonic() < _esquema_reintento:
+            return
+        try:
+            repo.ensure_schema()
+            _esquema_listo = True
+        except Exception as e:
+            _esquema_reintento = time.monotonic() + SCHEMA_RETRY_INTERVAL
+            print(f"⚠️ No se pudo aplicar el esquema (reintento en {SCHEMA_RETRY_INTERVAL}s): {e}")
+
+
+def utc_timestamp():
+    """Timestamp UTC en el mismo formato que CURRENT_TIMESTAMP"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class EventBuffer:
+    """
+    Acumula eventos de tracking en memoria y los escribe por lotes.
+    Se vacía al llegar a EVENT_FLUSH_SIZE eventos o cada EVENT_FLUSH_INTERVAL
+    segundos, con un solo executemany + commit por tabla. Si la escritura
+    falla se reintenta fila por fila: las filas que fallan solas mientras
+    otras sí se escriben son inválidas y se descartan; si no se escribe
+    ninguna, el lote vuelve a la cola (hasta EVENT_MAX_PENDING filas por
+    tabla) y se reintenta en el siguiente ciclo.
+    """
+
+    COLUMNS = {
+        'email_opens': OPEN_COLUMNS,
+        'email_clicks': CLICK_COLUMNS,
+    }
+    # Fallos seguidos sin ninguna fila escrita: la base está caída, no seguir fila por fila
+    ISOLATION_PROBE = 10
+
+    def __init__(self, flush_size, flush_interval, max_pending):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {tabla: [] for tabla in self.COLUMNS}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, tabla, fila):
+        """Encola una fila para `tabla`; la escritura ocurre en segundo plano"""
+        self._ensure_thread()
+        with self._lock:
+            self._pending[tabla].append(fila)
+            self._count += 1
+            lleno = self._count >= self.flush_size
+        if lleno:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Escribe todos los eventos pendientes en la base de datos.
+        Devuelve False si falló (el lote queda encolado para reintentar).
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {tabla: [] for tabla in self.COLUMNS}
+            self._count = 0
+        if not any(pending.values()):
+            return True
+        try:
+            repo.insert_events(pending['email_opens'], pending['email_clicks'])
+        except ShardWriteError as e:
+            # Los shards que escribieron ya confirmaron: solo se reintentan las filas de los que fallaron
+            print(f"❌ Error escribiendo lote de eventos en shards, reintentando fila por fila: {e}")
+            return self._write_rows({'email_opens': e.opens, 'email_clicks': e.clicks})
+        except Exception as e:
+            print(f"❌ Error escribiendo lote de eventos, reintentando fila por fila: {e}")
+            return self._write_rows(pending)
+        return True
+
+    def _write_rows(self, pending):
+        # Aísla filas que fallan siempre (p. ej. valores que la base rechaza)
+        # para que no bloqueen la cola reintentándose al frente para siempre
+        escritas = fallos = 0
+        descartadas = []
+        for tabla, filas in pending.items():
+            for fila in filas:
+                if not escritas and fallos >= self.ISOLATION_PROBE:
+                    print("❌ La base no acepta eventos, el lote se reintentará")
+                    self._requeue(pending)
+                    return False
+                try:
+                    if tabla == 'email_opens':
+                        repo.insert_events([fila], [])
+                    else:
+                        repo.insert_events([], [fila])
+                    escritas += 1
+                except Exception as e:
+                    fallos += 1
+                    descartadas.append((tabla, fila, e))
+        if descartadas and not escritas:
+            self._requeue(pending)
+            return False
+        for tabla, fila, e in descartadas:
+            print(f"❌ Evento de {tabla} descartado ({fila[0]!r}): {e}")
+        return True
+
+    def _requeue(self, pending):
+        # El lote fallido va antes de lo que llegó mientras tanto
+        with self._lock:
+            for tabla, filas in pending.items():
+                filas = filas + self._pending[tabla]
+                descartadas = len(filas) - self.max_pending
+                if descartadas > 0:
+                    print(f"❌ {descartadas} eventos de {tabla} descartados: la cola de reintentos está llena")
+                    filas = filas[descartadas:]
+                self._pending[tabla] = filas
+            self._count = sum(len(filas) for filas in self._pending.values())
+
+    def _ensure_thread(self):
+        # Cada worker de gunicorn necesita su propio hilo (no sobrevive a fork)
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self.flush():
+                # Con la base caída la cola sigue llena: no reintentar en cada request
+                time.sleep(self.flush_interval)
+
+
+class LinkTable:
+    """
+    Tabla token -> URL precargada en memoria para los redirects de clicks.
+    resolve() nunca consulta la base de datos; un hilo la refresca cada
+    LINKS_REFRESH_INTERVAL segundos, o antes si se pidió un token desconocido
+    (a lo sumo una vez cada LINKS_MISS_REFRESH_INTERVAL segundos).
+    """
+
+    def __init__(self, refresh_interval, miss_refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self._refreshed_at = 0.0
+        self._links = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def resolve(self, token):
+        """Devuelve la URL destino del token o None si no existe"""
+        self._ensure_thread()
+        url = self._links.get(token)
+        if url is None and time.monotonic() - self._refreshed_at >= self.miss_refresh_interval:
+            self._wakeup.set()
+        return url
+
+    def add(self, token, url):
+        """Registra un link en la base de datos y en la tabla local"""
+        repo.insert_link(token, url)
+        self._links[token] = url
+
+    def refresh(self):
+        """Recarga la tabla completa desde la base de datos"""
+        self._refreshed_at = time.monotonic()
+        try:
+            links = dict(repo.list_links())
+        except Exception as e:
+            print(f"⚠️ No se pudo refrescar la tabla de links: {e}")
+            return
+        # Reemplazo atómico: los lectores nunca ven una tabla a medio cargar
+        self._links = links
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
+
+
+def opens_columnar(filas):
+    """
+    Arma el formato columnar de /stats en una pasada sobre las filas del
+    cursor: un array por campo, con institución y user-agent codificados
+    como índices a un diccionario de valores únicos
+    """
+    email_ids = []
+    timestamps = []
+    ips = []
+    instituciones = []
+    user_agents = []
+    dic_instituciones = {}
+    dic_user_agents = {}
+
+    for email_id, institucion, timestamp, ip, user_agent in filas:
+        email_ids.append(email_id)
+        timestamps.append(timestamp if timestamp.__class__ is str else str(timestamp))
+        ips.append(ip)
+        indice = dic_instituciones.get(institucion)
+        if indice is None:
+            indice = dic_instituciones[institucion] = len(dic_instituciones)
+        instituciones.append(indice)
+        indice = dic_user_agents.get(user_agent)
+        if indice is None:
+            indice = dic_user_agents[user_agent] = len(dic_user_agents)
+        user_agents.append(indice)
+
+    return {
+        'email_id': email_ids,
+        'institucion': instituciones,
+        'timestamp': timestamps,
+        'ip': ips,
+        'user_agent': user_agents,
+        'diccionarios': {
+            'institucion': list(dic_instituciones),
+            'user_agent': list(dic_user_agents)
+        }
+    }
+
+
+def json_response(payload):
+    """Respuesta JSON serializada con orjson si está disponible"""
+    if orjson is not None:
+        return Response(orjson.dumps(payload), mimetype='application/json')
+    return jsonify(payload)
+
+
+def parse_event_timestamp(valor):
+    """Normaliza epoch (segundos) o ISO 8601 al formato UTC de la base de datos"""
+    if isinstance(valor, bool):
+        raise ValueError('timestamp inválido')
+    if isinstance(valor, (int, float)):
+        dt = datetime.fromtimestamp(valor, timezone.utc)
+    elif isinstance(valor, str):
+        dt = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc)
     else:
-        conn = sqlite3.connect(DATABASE)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS email_opens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email_id TEXT NOT NULL,
-                institucion TEXT,
-                autoridad TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT,
-                user_agent TEXT
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS formulario_contacto (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                email TEXT NOT NULL,
-                institucion TEXT,
-                telefono TEXT,
-                dia TEXT,
-                horario TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        print("✅ SQLite inicializado")
+        raise ValueError('timestamp inválido')
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def texto_opcional(evento, campo, default=None):
+    """Campo de texto opcional de un evento: str (con largo máximo) o None"""
+    valor = evento.get(campo)
+    if valor is None:
+        valor = default
+    if valor is not None and not (isinstance(valor, str) and len(valor) <= INGEST_FIELD_LIMITS[campo]):
+        raise ValueError(f'{campo} debe ser texto de hasta {INGEST_FIELD_LIMITS[campo]} caracteres')
+    # PostgreSQL (text y COPY) rechaza NUL: fallaría el lote entero
+    if valor is not None and '\x00' in valor:
+        raise ValueError(f'{campo} no puede contener NUL')
+    return valor
+
+
+def validar_evento(evento, provider):
+    """
+    Valida un evento de ESP y lo convierte a la tupla de
+    Repository.ingest_events. Lanza ValueError con el motivo si no es válido.
+    """
+    if not isinstance(evento, dict):
+        raise ValueError('el evento debe ser un objeto')
+
+    event_id = evento.get('event_id')
+    if not isinstance(event_id, str) or not event_id or len(event_id) > 200:
+        raise ValueError('event_id requerido')
+    if '\x00' in event_id:
+        raise ValueError('event_id no puede contener NUL')
+
+    tipo = evento.get('type')
+    if tipo not in INGEST_EVENT_TYPES:
+        raise ValueError(f"type debe ser uno de {', '.join(INGEST_EVENT_TYPES)}")
+
+    email_id = evento.get('email_id')
+    if not isinstance(email_id, str):
+        raise ValueError('email_id requerido')
+    try:
+        tid = tracking_ids.decode(email_id)
+    except tracking_ids.InvalidTrackingId as e:
+        raise ValueError(f'email_id inválido: {e}')
+
+    if 'timestamp' not in evento:
+        raise ValueError('timestamp requerido')
+    timestamp = parse_event_timestamp(evento['timestamp'])
+
+    url = texto_opcional(evento, 'url')
+    if tipo == 'click' and not (url and url.startswith(('http://', 'https://'))):
+        raise ValueError('click requiere url http(s)')
+
+    provider = texto_opcional(evento, 'provider', default=provider)
+    if not provider:
+        raise ValueError('provider requerido')
+    return (provider, event_id, tipo, email_id, timestamp, url,
+            texto_opcional(evento, 'ip'), texto_opcional(evento, 'user_agent'),
+            tid.institucion, tid.campaign, tid.recipient)
+
+
+def leer_eventos():
+    """
+    Itera los eventos del body: JSON array o NDJSON (un objeto por línea,
+    leído como stream). Líneas NDJSON ilegibles se entregan como None.
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl', 'application/ndjson'):
+        for linea in request.stream:
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                yield json.loads(linea)
+            except ValueError:
+                yield None
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('events')
+        if not isinstance(data, list):
+            raise ValueError('se esperaba un array JSON o NDJSON')
+        yield from data
+
+
+def funnel_report(limit=100):
+    """
+    Reporte del funnel enviado → abierto → click → formulario, con tiempos
+    hasta la primera apertura (desde el envío) y hasta el formulario (desde
+    la primera apertura)
+    """
+    resumen = repo.funnel_summary()
+    convertidos = [{
+        'email_id': row.email_id,
+        'institucion': row.institucion,
+        'first_open_at': str(row.first_open_at) if row.first_open_at is not None else None,
+        'form_at': str(row.form_at),
+        'segundos_hasta_formulario': float(row.t_form) if row.t_form is not None else None
+    } for row in repo.funnel_conversions(limit)]
+
+    def redondear(valor):
+        return round(float(valor), 1) if valor is not None else None
+
+    return {
+        # Todo destinatario con eventos se considera enviado
+        'enviados': resumen.total,
+        'enviados_registrados': resumen.enviados,
+        'abiertos': resumen.abiertos,
+        'clicks': resumen.clicks,
+        'formularios': resumen.formularios,
+        'segundos_hasta_apertura': {'promedio': redondear(resumen.avg_open),
+                                    'mediana': redondear(resumen.median_open)},
+        'segundos_hasta_formulario': {'promedio': redondear(resumen.avg_form),
+                                      'mediana': redondear(resumen.median_form)},
+        'convertidos': convertidos
+    }
+
+
+event_buffer = EventBuffer(EVENT_FLUSH_SIZE, EVENT_FLUSH_INTERVAL, EVENT_MAX_PENDING)
+link_table = LinkTable(LINKS_REFRESH_INTERVAL, LINKS_MISS_REFRESH_INTERVAL)
+live_counters = LiveCounters(repo, LIVE_COUNTERS_NAME)
+atexit.register(event_buffer.flush)
+atexit.register(live_counters.close)
 
 
 def enviar_email_formulario(data):
@@ -213,31 +582,20 @@ def enviar_email_formulario(data):
 def track_email(email_id):
     """
     Pixel de tracking - registra cuando se abre el email
+    IDs falsificados o mal formados responden 400 sin escribir nada
     """
-    conn = get_db_connection()
-
     ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
     user_agent = request.headers.get('User-Agent', '')
 
-    # Extraer institución del email_id (formato: institucion_timestamp)
-    parts = email_id.split('_')
-    institucion = ' '.join(parts[:-1]).replace('-', ' ').title() if len(parts) > 1 else 'Desconocido'
-
-    if USE_POSTGRES:
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO email_opens (email_id, institucion, ip_address, user_agent)
-            VALUES (%s, %s, %s, %s)
-        ''', (email_id, institucion, ip_address, user_agent))
-    else:
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO email_opens (email_id, institucion, ip_address, user_agent)
-            VALUES (?, ?, ?, ?)
-        ''', (email_id, institucion, ip_address, user_agent))
+    # Validar el ID (firmado o formato antiguo institucion_timestamp) antes de escribir
+    try:
+        tid = tracking_ids.decode(email_id)
+    except tracking_ids.InvalidTrackingId:
+        abort(400)
 
-    conn.commit()
-    conn.close()
+    event_buffer.add('email_opens', (email_id, tid.institucion, utc_timestamp(), ip_address, user_agent,
+                                     tid.campaign, tid.recipient))
+    live_counters.record_open(email_id, tid.institucion)
 
     # Crear pixel transparente 1x1
     pixel = io.BytesIO()
@@ -247,74 +605,148 @@ def track_email(email_id):
     return send_file(pixel, mimetype='image/gif')
 
 
+@app.route('/r/<token>')
+def redirect_click(token):
+    """
+    Redirect de tracking - registra el click y redirige al destino
+    Formato: /r/<token>?e=<email_id>
+    """
+    url = link_table.resolve(token)
+    if url is None:
+        abort(404)
+
+    # Un ID inválido no bloquea el redirect, pero no se asocia al click
+    email_id = request.args.get('e')
+    if email_id is not None:
+        try:
+            tracking_ids.decode(email_id)
+        except tracking_ids.InvalidTrackingId:
+            email_id = None
+
+    ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+    user_agent = request.headers.get('User-Agent', '')
+
+    event_buffer.add('email_clicks', (email_id, token, url, utc_timestamp(), ip_address, user_agent))
+
+    response = redirect(url, code=302)
+    if email_id is not None:
+        # Permite asociar el formulario de /agendar-reunion al destinatario
+        response.set_cookie('tracking_id', email_id, max_age=30 * 24 * 3600, samesite='Lax')
+    return response
+
+
+@app.route('/links', methods=['POST'])
+def crear_link():
+    """
+    Registra un link rastreable. Body JSON: {"url": "...", "token": "opcional"}
+    Requiere Authorization: Bearer <LINKS_TOKEN> (sin él, cualquiera podría
+    usar /r/ como redirect abierto)
+    """
+    if LINKS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {LINKS_TOKEN}':
+            return jsonify({'success': False, 'message': 'no autorizado'}), 401
+    elif USE_POSTGRES:
+        return jsonify({'success': False, 'message': 'LINKS_TOKEN no configurado'}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'body JSON inválido'}), 400
+    url = data.get('url')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        return jsonify({'success': False, 'message': 'url debe ser http(s)'}), 400
+    token = data.get('token')
+    if token is not None and not isinstance(token, str):
+        return jsonify({'success': False, 'message': 'token debe ser texto'}), 400
+
+    token = token or secrets.token_urlsafe(8)
+    try:
+        link_table.add(token, url)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+
+    return jsonify({'success': True, 'token': token, 'url': url, 'redirect': f'/r/{token}'})
+
+
+@app.route('/ingest/events', methods=['POST'])
+def ingest_events():
+    """
+    Ingesta masiva de eventos (open/click/bounce) enviados por proveedores.
+    Body: JSON array o NDJSON. Idempotente por (provider, event_id).
+    """
+    if INGEST_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {INGEST_TOKEN}':
+            return jsonify({'success': False, 'message': 'no autorizado'}), 401
+    elif USE_POSTGRES:
+        return jsonify({'success': False, 'message': 'INGEST_TOKEN no configurado'}), 401
+    # Rechazar antes de leer el body (los NDJSON sin Content-Length los corta MAX_CONTENT_LENGTH)
+    if request.content_length is not None and request.content_length > INGEST_MAX_BYTES:
+        return jsonify({'success': False, 'message': f'body de más de {INGEST_MAX_BYTES} bytes'}), 413
+
+    provider = request.args.get('provider', 'esp')
+    validos = []
+    errores = []
+    recibidos = 0
+    try:
+        for evento in leer_eventos():
+            recibidos += 1
+            if recibidos > INGEST_MAX_EVENTS:
+                return jsonify({'success': False,
+                                'message': f'máximo {INGEST_MAX_EVENTS} eventos por lote'}), 413
+            try:
+                validos.append(validar_evento(evento, provider))
+            except (ValueError, TypeError, OverflowError) as e:
+                if len(errores) < 100:
+                    errores.append({'indice': recibidos - 1, 'error': str(e)})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    nuevos = repo.ingest_events(validos) if validos else []
+    for evento in nuevos:
+        if evento[2] == 'open':
+            live_counters.record_open(evento[3], evento[8], evento[4])
+    insertados = len(nuevos)
+
+    return jsonify({
+        'success': True,
+        'recibidos': recibidos,
+        'validos': len(validos),
+        'insertados': insertados,
+        'duplicados': len(validos) - insertados,
+        'invalidos': recibidos - len(validos),
+        'errores': errores
+    })
+
+
 @app.route('/stats')
 def get_stats():
     """
     API para obtener estadísticas de aperturas
+    ?format=columnar devuelve las aperturas por columnas (ver opens_columnar)
+    Cifras exactas desde la base; /stats/live da las cifras en vivo sin consultarla
     """
-    conn = get_db_connection()
-
-    if USE_POSTGRES:
-        c = conn.cursor()
-
-        # Total de aperturas
-        c.execute('SELECT COUNT(*) FROM email_opens')
-        total_aperturas = c.fetchone()[0]
-
-        # Emails únicos
-        c.execute('SELECT COUNT(DISTINCT email_id) FROM email_opens')
-        emails_unicos = c.fetchone()[0]
-
-        # Promedio de aperturas
-        promedio = total_aperturas / emails_unicos if emails_unicos > 0 else 0
-
-        # Detalles de aperturas
-        c.execute('''
-            SELECT email_id, institucion, timestamp, ip_address, user_agent
-            FROM email_opens
-            ORDER BY timestamp DESC
-        ''')
-        rows = c.fetchall()
-        aperturas = []
-        for row in rows:
-            aperturas.append({
-                'email_id': row[0],
-                'institucion': row[1],
-                'timestamp': str(row[2]),
-                'ip': row[3],
-                'user_agent': row[4]
-            })
-    else:
-        c = conn.cursor()
-
-        # Total de aperturas
-        c.execute('SELECT COUNT(*) FROM email_opens')
-        total_aperturas = c.fetchone()[0]
-
-        # Emails únicos
-        c.execute('SELECT COUNT(DISTINCT email_id) FROM email_opens')
-        emails_unicos = c.fetchone()[0]
-
-        # Promedio de aperturas
-        promedio = total_aperturas / emails_unicos if emails_unicos > 0 else 0
-
-        # Detalles de aperturas
-        c.execute('''
-            SELECT email_id, institucion, timestamp, ip_address, user_agent
-            FROM email_opens
-            ORDER BY timestamp DESC
-        ''')
-        aperturas = []
-        for row in c.fetchall():
-            aperturas.append({
-                'email_id': row[0],
-                'institucion': row[1],
-                'timestamp': row[2],
-                'ip': row[3],
-                'user_agent': row[4]
-            })
-
-    conn.close()
+    total_aperturas, emails_unicos = repo.stats_summary()
+
+    # Promedio de aperturas
+    promedio = total_aperturas / emails_unicos if emails_unicos > 0 else 0
+
+    # Formato columnar: un array por campo, sin un dict por fila
+    if request.args.get('format') == 'columnar':
+        return json_response({
+            'total_aperturas': total_aperturas,
+            'emails_unicos': emails_unicos,
+            'promedio_aperturas': round(promedio, 1),
+            'formato': 'columnar',
+            'aperturas': opens_columnar(repo.iter_opens())
+        })
+
+    # Detalles de aperturas
+    aperturas = [{
+        'email_id': row.email_id,
+        'institucion': row.institucion,
+        'timestamp': str(row.timestamp),
+        'ip': row.ip,
+        'user_agent': row.user_agent
+    } for row in repo.list_opens()]
 
     return jsonify({
         'total_aperturas': total_aperturas,
@@ -324,6 +756,103 @@ def get_stats():
     })
 
 
+@app.route('/stats/live')
+def get_live_stats():
+    """
+    Cifras en vivo desde memoria compartida, sin consultar la base de datos.
+    Incluyen aperturas aún no escritas en la base; emails_unicos_aprox es una
+    estimación (HyperLogLog, ~0.8%), a diferencia del emails_unicos exacto de /stats
+    """
+    live = live_counters.snapshot()
+    if live is None:
+        return jsonify({'success': False, 'message': 'contadores en vivo no disponibles'}), 503
+
+    return jsonify({
+        'total_aperturas': live.total,
+        'aperturas_ultimos_5_min': live.ultimos_5_min,
+        'emails_unicos_aprox': live.emails_unicos,
+        'promedio_aperturas_aprox': round(live.total / live.emails_unicos, 1) if live.emails_unicos else 0,
+        'aperturas_por_institucion': live.por_institucion
+    })
+
+
+@app.route('/sends', methods=['POST'])
+def registrar_envios():
+    """
+    Registra envíos para el funnel. Body JSON:
+        {"email_ids": ["...", {"email_id": "...", "sent_at": "2024-01-01T10:00:00Z"}, ...]}
+    sent_at (epoch o ISO 8601) es opcional; por defecto, la hora del servidor.
+    """
+    data = request.get_json(silent=True)
+    email_ids = data.get('email_ids') if isinstance(data, dict) else None
+    if not isinstance(email_ids, list) or not all(isinstance(e, (str, dict)) for e in email_ids):
+        return jsonify({'success': False, 'message': 'email_ids debe ser una lista de textos u objetos'}), 400
+    timestamp = utc_timestamp()
+
+    filas = []
+    for item in email_ids:
+        email_id, sent_at = (item.get('email_id'), item.get('sent_at')) if isinstance(item, dict) else (item, None)
+        try:
+            tid = tracking_ids.decode(email_id)
+            sent_at = timestamp if sent_at is None else parse_event_timestamp(sent_at)
+        except (tracking_ids.InvalidTrackingId, ValueError, TypeError, OverflowError):
+            continue
+        filas.append((email_id, tid.institucion, sent_at))
+
+    repo.register_sends(filas)
+
+    return jsonify({'success': True, 'registrados': len(filas), 'rechazados': len(email_ids) - len(filas)})
+
+
+@app.route('/stats/funnel')
+def get_funnel():
+    """
+    Funnel por destinatario: enviado → abierto → click → formulario
+    """
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    return jsonify(funnel_report(limit))
+
+
+@app.route('/search')
+def search():
+    """
+    Búsqueda por prefijo/subcadena en destinatarios (institución, email_id)
+    y formularios (nombre, email, institución). Paginada: ?q=&page=&per_page=
+    """
+    texto = request.args.get('q', '').strip()
+    if not texto:
+        return jsonify({'success': False, 'message': 'q requerido'}), 400
+    if len(texto) > 100:
+        return jsonify({'success': False, 'message': 'q demasiado largo'}), 400
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+    # Se pide un resultado extra para saber si hay otra página
+    destinatarios, formularios = repo.search(texto, limit=per_page + 1, offset=(page - 1) * per_page)
+
+    return jsonify({
+        'q': texto,
+        'page': page,
+        'per_page': per_page,
+        'destinatarios': [{
+            'email_id': row.email_id,
+            'institucion': row.institucion,
+            'aperturas': row.opens,
+            'ultima_apertura': str(row.last_open_at) if row.last_open_at is not None else None,
+            'formulario': str(row.form_at) if row.form_at is not None else None
+        } for row in destinatarios[:per_page]],
+        'formularios': [{
+            'nombre': row.nombre,
+            'email': row.email,
+            'institucion': row.institucion,
+            'timestamp': str(row.timestamp),
+            'email_id': row.email_id
+        } for row in formularios[:per_page]],
+        'hay_mas': len(destinatarios) > per_page or len(formularios) > per_page
+    })
+
+
 @app.route('/')
 def dashboard():
     """
@@ -340,7 +869,8 @@ def health():
     db_type = "PostgreSQL" if USE_POSTGRES else "SQLite"
     return jsonify({
         'status': 'ok',
-        'database': db_type
+        'database': db_type,
+        'shards': len(repo.shards) if isinstance(repo, ShardedRepository) else 1
     })
 
 
@@ -607,30 +1137,22 @@ def formulario():
 
         # Asegurar que las tablas existen antes de insertar
         try:
-            init_db()
+            repo.ensure_schema()
         except:
             pass  # Si ya existen, continuar
 
-        # Guardar en base de datos
-        conn = get_db_connection()
-
-        if USE_POSTGRES:
-            c = conn.cursor()
-            c.execute('''
-                INSERT INTO formulario_contacto (nombre, email, institucion, telefono, dia, horario, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            ''', (data.get('nombre'), data.get('email'), data.get('institucion'),
-                  data.get('telefono'), data.get('dia'), data.get('horario')))
-        else:
-            c = conn.cursor()
-            c.execute('''
-                INSERT INTO formulario_contacto (nombre, email, institucion, telefono, dia, horario, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
-            ''', (data.get('nombre'), data.get('email'), data.get('institucion'),
-                  data.get('telefono'), data.get('dia'), data.get('horario')))
+        # Destinatario que llegó desde el email (cookie del redirect de clicks)
+        email_id = data.get('email_id') or request.cookies.get('tracking_id')
+        if email_id is not None:
+            try:
+                tracking_ids.decode(email_id)
+            except tracking_ids.InvalidTrackingId:
+                email_id = None
 
-        conn.commit()
-        conn.close()
+        # Guardar en base de datos
+        repo.insert_form(data.get('nombre'), data.get('email'), data.get('institucion'),
+                         data.get('telefono'), data.get('dia'), data.get('horario'),
+                         utc_timestamp(), email_id)
 
         print(f"✅ Datos guardados en BD para: {data.get('institucion')}")
 
@@ -869,6 +1391,7 @@ def setup_db():
     """
     try:
         init_db()
+        repo.rebuild_funnel()
         return jsonify({'success': True, 'message': 'Database initialized successfully'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
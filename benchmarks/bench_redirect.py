@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Benchmark de latencia del endpoint de clicks /r/<token>
+Uso: python benchmarks/bench_redirect.py [iteraciones]
+Corre contra una base SQLite temporal (no toca email_tracking.db)
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.pop('DATABASE_URL', None)
+
+import app as tracking  # noqa: E402
+from live_counters import LiveCounters  # noqa: E402
+from repository import Repository  # noqa: E402
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tracking.repo = Repository(sqlite_path=os.path.join(tmp, 'bench.db'))
+        # Contadores propios: no tocar el segmento de un servicio en marcha
+        tracking.live_counters = LiveCounters(tracking.repo, f'bench_live_{os.getpid()}')
+        tracking.init_db()
+
+        for i in range(1000):
+            tracking.link_table.add(f'link{i}', f'https://itseia.ai/agendar-reunion?v={i}')
+
+        client = tracking.app.test_client()
+        latencias = []
+        for i in range(iteraciones):
+            inicio = time.perf_counter()
+            resp = client.get(f'/r/link{i % 1000}?e=colegio-san-jose_{1700000000 + i}')
+            latencias.append(time.perf_counter() - inicio)
+            assert resp.status_code == 302
+
+        tracking.event_buffer.flush()
+
+        print(f"/r/<token>  n={iteraciones}")
+        print(f"  p50  {percentil(latencias, 0.50) * 1e6:8.1f} µs")
+        print(f"  p95  {percentil(latencias, 0.95) * 1e6:8.1f} µs")
+        print(f"  p99  {percentil(latencias, 0.99) * 1e6:8.1f} µs")
+
+        inicio = time.perf_counter()
+        for i in range(iteraciones):
+            tracking.link_table.resolve(f'link{i % 1000}')
+        print(f"  resolve() {(time.perf_counter() - inicio) / iteraciones * 1e9:8.1f} ns/op")
+        tracking.live_counters.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /stats: formato por filas (jsonify) vs columnar (orjson)
+Uso: python benchmarks/bench_stats_format.py [aperturas] [repeticiones]
+Corre contra una base SQLite temporal (no toca email_tracking.db)
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('SHARDS', None)
+
+import app as tracking  # noqa: E402
+from live_counters import LiveCounters  # noqa: E402
+from repository import Repository  # noqa: E402
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Microsoft Office/16.0 (Windows NT 10.0; Microsoft Outlook 16.0.17029; Pro)',
+    'GoogleImageProxy',
+]
+
+
+def medir(client, url, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resp = client.get(url)
+        tiempos.append(time.perf_counter() - inicio)
+        assert resp.status_code == 200
+    return min(tiempos), len(resp.data)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tracking.repo = Repository(sqlite_path=os.path.join(tmp, 'bench.db'))
+        # Contadores propios: no tocar el segmento de un servicio en marcha
+        tracking.live_counters = LiveCounters(tracking.repo, f'bench_live_{os.getpid()}')
+        tracking.init_db()
+
+        random.seed(1)
+        instituciones = [f'colegio-{i}' for i in range(300)]
+        opens = []
+        for i in range(n):
+            slug = random.choice(instituciones)
+            opens.append((f'{slug}_{1700000000 + i}', slug.replace('-', ' ').title(),
+                          f'2026-10-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{i % 60:02d}',
+                          f'10.0.{i % 256}.{i % 251}', random.choice(USER_AGENTS), None, None))
+        tracking.repo.insert_events(opens, [])
+
+        client = tracking.app.test_client()
+        print(f"/stats  aperturas={n}  serializador={'orjson' if tracking.orjson else 'json'}")
+        for nombre, url in (('filas', '/stats'), ('columnar', '/stats?format=columnar')):
+            segundos, tamano = medir(client, url, repeticiones)
+            print(f"  {nombre:<9} {segundos * 1000:8.1f} ms  {tamano / 1024:9.1f} KiB")
+        tracking.live_counters.unlink()
+
+
+if __name__ == '__main__':
+    main()
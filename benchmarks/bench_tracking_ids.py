@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Benchmark del costo de decodificar/verificar IDs de tracking por hit
+Uso: python benchmarks/bench_tracking_ids.py [iteraciones]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tracking_ids  # noqa: E402
+
+
+def medir(nombre, ids, iteraciones):
+    n = len(ids)
+    inicio = time.perf_counter()
+    for i in range(iteraciones):
+        try:
+            tracking_ids.decode(ids[i % n])
+        except tracking_ids.InvalidTrackingId:
+            pass
+    print(f"  {nombre:<10} {(time.perf_counter() - inicio) / iteraciones * 1e9:8.1f} ns/hit")
+
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    firmados = [tracking_ids.encode(7, r) for r in range(1000)]
+    antiguos = [f'colegio-san-jose_{1700000000 + r}' for r in range(1000)]
+    falsos = [i[:-2] + ('AA' if not i.endswith('AA') else 'BB') for i in firmados]
+
+    print(f"decode()  n={iteraciones}  (ej: {firmados[42]})")
+    medir('firmado', firmados, iteraciones)
+    medir('antiguo', antiguos, iteraciones)
+    medir('falso', falsos, iteraciones)
+
+
+if __name__ == '__main__':
+    main()
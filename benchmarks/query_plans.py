@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Regresiones de planes de consulta a escala
+Siembra una base con 1M de aperturas sintéticas, captura el plan de cada
+sentencia de repository.py (EXPLAIN QUERY PLAN en SQLite, EXPLAIN (FORMAT
+JSON) en PostgreSQL) y falla si alguna hace un scan completo o un sort en
+tabla temporal que no estaba en benchmarks/query_plans_baseline.json.
+También registra el tiempo de ejecución de cada sentencia.
+
+Uso:
+    python benchmarks/query_plans.py [--rows N] [--update] [--report PATH]
+
+SQLite siempre se revisa (base temporal). PostgreSQL solo si está definida
+PLAN_CHECK_DATABASE_URL, que debe apuntar a una base descartable: sus
+tablas se borran y se vuelven a sembrar. Un dialecto sin sección en la
+baseline se reporta pero no se compara. PLAN_CHECK_SSLMODE (default
+'prefer') permite usar un servidor local sin SSL.
+
+--update reescribe la baseline del dialecto con los planes actuales.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tracking_ids  # noqa: E402
+from repository import (  # noqa: E402
+    Repository, OPEN_COLUMNS, CLICK_COLUMNS, FORM_COLUMNS, ESP_EVENT_COLUMNS, RECIPIENT_TABLES, REBUILD_FUNNEL,
+    INGEST_STAGING, INGEST_MERGE
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans_baseline.json')
+DEFAULT_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans_report.json')
+
+EMAIL_ID = tracking_ids.encode(7, 4242)
+TIMESTAMP = '2026-10-15 12:00:00'
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+
+# Parámetros de ejemplo por sentencia. Toda sentencia nueva de repository.py
+# tiene que aparecer aquí (o en search_statements) o el chequeo falla.
+SAMPLE_PARAMS = {
+    'insert_open': (EMAIL_ID, 'Colegio Plan', TIMESTAMP, '10.0.0.1', USER_AGENT, 7, 4242),
+    'insert_click': (EMAIL_ID, 'link1', 'https://itseia.ai/agendar-reunion', TIMESTAMP, '10.0.0.1', USER_AGENT),
+    'insert_form': ('Ana', 'ana@colegio.edu.ec', 'Colegio Plan', '0999999999', 'Lunes', '10:00',
+                    TIMESTAMP, EMAIL_ID),
+    'insert_link': (f'plan-{time.time_ns()}', 'https://itseia.ai'),
+    'list_links': (),
+    'count_opens': (),
+    'count_unique_emails': (),
+    'list_opens': (),
+    'count_opens_by_institucion': (),
+    'count_opens_since': (TIMESTAMP,),
+    'list_open_email_ids': (),
+    'funnel_open': (EMAIL_ID, 'Colegio Plan', TIMESTAMP, TIMESTAMP),
+    'funnel_click': (EMAIL_ID, TIMESTAMP),
+    'funnel_form': (EMAIL_ID, 'Colegio Plan', TIMESTAMP),
+    'funnel_send': (EMAIL_ID, 'Colegio Plan', TIMESTAMP),
+    'funnel_summary': (),
+    'funnel_median_open': (),
+    'funnel_median_form': (),
+    'funnel_conversions': (100,),
+}
+
+
+# --- Siembra -------------------------------------------------------------
+
+def generar_datos(rows):
+    """Aperturas, clicks, formularios y eventos de ESP sintéticos"""
+    random.seed(42)
+    destinatarios = max(rows // 10, 1)
+    email_ids = [tracking_ids.encode(r % 50, r) for r in range(destinatarios)]
+    instituciones = [f'Colegio {i} de Prueba' for i in range(2000)]
+
+    def ts(i):
+        return f'2026-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}'
+
+    opens = []
+    for i in range(rows):
+        r = random.randrange(destinatarios)
+        opens.append((email_ids[r], instituciones[r % len(instituciones)], ts(i),
+                      f'10.{i % 256}.{(i // 256) % 256}.{i % 251}', USER_AGENT, r % 50, r))
+    clicks = [(email_ids[random.randrange(destinatarios)], f'link{i % 1000}', f'https://itseia.ai/l/{i % 1000}',
+               ts(i), '10.0.0.1', USER_AGENT) for i in range(rows // 10)]
+    forms = [(f'Contacto {i}', f'contacto{i}@colegio.edu.ec', instituciones[i % len(instituciones)],
+              '0999999999', 'Lunes', '10:00', ts(i), email_ids[(i * 13) % destinatarios])
+             for i in range(max(destinatarios // 10, 1))]
+    esp = [('sendgrid', f'ev{i}', 'open', email_ids[i % destinatarios], ts(i), None, '10.0.0.1', USER_AGENT)
+           for i in range(rows // 10)]
+    links = [(f'link{i}', f'https://itseia.ai/l/{i}') for i in range(1000)]
+    return {
+        'email_opens': (OPEN_COLUMNS, opens),
+        'email_clicks': (CLICK_COLUMNS, clicks),
+        'formulario_contacto': (FORM_COLUMNS, forms),
+        'esp_events': (ESP_EVENT_COLUMNS, esp),
+        'email_links': (('token', 'url'), links),
+    }
+
+
+def sembrar_sqlite(path, datos):
+    import sqlite3
+    conn = sqlite3.connect(path)
+    for tabla, (columnas, filas) in datos.items():
+        conn.executemany(f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})",
+                         filas)
+    conn.commit()
+    conn.close()
+
+
+def sembrar_postgres(url, sslmode, datos):
+    import psycopg2
+    conn = psycopg2.connect(url, sslmode=sslmode)
+    with conn.cursor() as cur:
+        for tabla, (columnas, filas) in datos.items():
+            buffer = io.StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(filas)
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    conn.commit()
+    conn.close()
+
+
+def limpiar_postgres(url, sslmode):
+    import psycopg2
+    conn = psycopg2.connect(url, sslmode=sslmode)
+    with conn.cursor() as cur:
+        for tabla in list(RECIPIENT_TABLES) + ['email_links']:
+            cur.execute(f'DROP TABLE IF EXISTS {tabla} CASCADE')
+    conn.commit()
+    conn.close()
+
+
+# --- Planes --------------------------------------------------------------
+
+def marcadores(dialect, plan):
+    """Scans completos y sorts en tabla temporal de un plan"""
+    encontrados = set()
+    if dialect == 'sqlite':
+        for linea in plan:
+            # La numeración de subconsultas cambia entre versiones de SQLite
+            linea = re.sub(r'\(subquery-\d+\)', '(subquery)', linea)
+            if linea.startswith('SCAN ') and 'VIRTUAL TABLE' not in linea and linea != 'SCAN CONSTANT ROW':
+                encontrados.add(linea)
+            elif 'TEMP B-TREE' in linea:
+                encontrados.add(linea)
+    else:
+        pendientes = [plan[0]['Plan']]
+        while pendientes:
+            nodo = pendientes.pop()
+            if nodo['Node Type'] == 'Seq Scan':
+                encontrados.add(f"Seq Scan on {nodo['Relation Name']}")
+            elif nodo['Node Type'] == 'Sort':
+                encontrados.add(f"Sort ({', '.join(nodo.get('Sort Key', []))})")
+            pendientes.extend(nodo.get('Plans', []))
+    return sorted(encontrados)
+
+
+def revisar(repo):
+    """{sentencia: {'plan', 'marcadores', 'segundos'}} para todas las sentencias"""
+    params = dict(SAMPLE_PARAMS)
+    for texto in ('colegio 12', 'co'):
+        params.update(repo.search_statements(texto, 20, 0))
+
+    faltantes = [n for n in repo.statement_names() if n not in params]
+    if faltantes:
+        print(f"❌ Sin parámetros de ejemplo: {', '.join(faltantes)} (agregar a SAMPLE_PARAMS)")
+        sys.exit(2)
+
+    resultados = {}
+    for nombre in repo.statement_names():
+        plan = repo.explain(nombre, params[nombre])
+        resultados[nombre] = {
+            'plan': plan,
+            'marcadores': marcadores(repo.dialect, plan),
+            'segundos': repo.timed(nombre, params[nombre]),
+        }
+    for i, sql in enumerate(REBUILD_FUNNEL):
+        plan = repo.explain_sql(sql)
+        resultados[f'rebuild_funnel[{i}]'] = {'plan': plan, 'marcadores': marcadores(repo.dialect, plan),
+                                              'segundos': None}
+    plan = repo.explain_sql(INGEST_MERGE, setup=(INGEST_STAGING[repo.dialect],))
+    resultados['ingest_merge'] = {'plan': plan, 'marcadores': marcadores(repo.dialect, plan), 'segundos': None}
+    return resultados
+
+
+def comparar(dialect, resultados, baseline):
+    """Lista de (sentencia, marcadores nuevos) respecto de la baseline"""
+    regresiones = []
+    base = baseline.get(dialect, {})
+    for nombre, r in resultados.items():
+        nuevos = sorted(set(r['marcadores']) - set(base.get(nombre, [])))
+        if nuevos:
+            regresiones.append((nombre, nuevos))
+    return regresiones
+
+
+def imprimir(dialect, resultados, regresiones):
+    malos = dict(regresiones)
+    print(f"\n{dialect}")
+    for nombre, r in resultados.items():
+        tiempo = f"{r['segundos'] * 1000:9.2f} ms" if r['segundos'] is not None else ' ' * 12
+        estado = '❌' if nombre in malos else '✅'
+        print(f"  {estado} {nombre:<26} {tiempo}  {'; '.join(r['marcadores']) or '-'}")
+        for marcador in malos.get(nombre, []):
+            print(f"       nuevo: {marcador}")
+
+
+def ejecutar(dialect, repo, rows, sembrar):
+    print(f"🌱 Sembrando {dialect} con {rows} aperturas...")
+    repo.init_schema()
+    inicio = time.perf_counter()
+    sembrar(generar_datos(rows))
+    repo.rebuild_funnel()
+    repo.analyze()
+    print(f"   listo en {time.perf_counter() - inicio:.1f} s")
+    return revisar(repo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--update', action='store_true', help='reescribe la baseline con los planes actuales')
+    parser.add_argument('--report', default=DEFAULT_REPORT)
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    reporte = {'rows': args.rows, 'dialectos': {}}
+    regresiones_total = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'plans.db')
+        repo = Repository(sqlite_path=path)
+        resultados = ejecutar('sqlite', repo, args.rows, lambda datos: sembrar_sqlite(path, datos))
+        reporte['dialectos']['sqlite'] = resultados
+        repo.close()
+
+    pg_url = os.environ.get('PLAN_CHECK_DATABASE_URL')
+    if pg_url:
+        sslmode = os.environ.get('PLAN_CHECK_SSLMODE', 'prefer')
+        limpiar_postgres(pg_url, sslmode)
+        repo = Repository(pg_url, sslmode=sslmode)
+        reporte['dialectos']['postgres'] = ejecutar('postgres', repo, args.rows,
+                                                    lambda datos: sembrar_postgres(pg_url, sslmode, datos))
+        repo.close()
+
+    for dialect, resultados in reporte['dialectos'].items():
+        if args.update:
+            baseline[dialect] = {n: r['marcadores'] for n, r in resultados.items()}
+            regresiones = []
+        elif dialect not in baseline:
+            # Sin baseline no hay contra qué comparar: todo saldría como "nuevo"
+            print(f"\n⚠️ Sin baseline para {dialect}: no se compara (generarla con --update)")
+            regresiones = []
+        else:
+            regresiones = comparar(dialect, resultados, baseline)
+        imprimir(dialect, resultados, regresiones)
+        regresiones_total.extend(regresiones)
+
+    with open(args.report, 'w') as f:
+        json.dump(reporte, f, indent=2, default=str)
+    print(f"\n📝 Reporte: {args.report}")
+
+    if args.update:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"📌 Baseline actualizada: {BASELINE_PATH}")
+    elif regresiones_total:
+        print(f"❌ {len(regresiones_total)} sentencia(s) con scans o sorts nuevos")
+        sys.exit(1)
+    else:
+        print("✅ Sin regresiones de planes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Contadores en vivo - Alianza ITSEIA-BYS
+Las cifras del dashboard (aperturas totales, últimos 5 minutos, por
+institución y emails únicos) viven en un segmento de
+multiprocessing.shared_memory compartido por todos los workers de gunicorn.
+Leerlas no consulta la base de datos.
+
+Cada worker escribe solo en su propio slot: un único escritor por slot y
+enteros de 8 bytes alineados, así que los incrementos no necesitan un lock
+entre procesos y un lector nunca ve un valor a medias. Quien lee suma todos
+los slots. El lock de archivo (flock) solo se toma para crear o sembrar el
+segmento, reclamar un slot o registrar una institución nueva.
+
+Disposición del segmento:
+    cabecera  MAGIC | instituciones registradas
+    nombres   MAX_INSTITUCIONES x NAME_BYTES (utf-8, el índice 0 es "sin institución")
+    slots     MAX_SLOTS x (pid | total | ring de segundos | ring de conteos |
+              conteos por institución | registros HyperLogLog)
+
+El slot 0 guarda la siembra desde la base de datos. Si al conectarse no
+queda ningún proceso vivo con slot (el servicio se reinició), el segmento
+se vacía y se vuelve a sembrar. Si la siembra falla (p. ej. la base aún no
+tiene tablas) el segmento queda sin MAGIC, los contadores inactivos y se
+reintenta cada SEED_RETRY_INTERVAL segundos. Los emails únicos son una estimación
+HyperLogLog (error ~0.8%).
+"""
+
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = 0x4C49564500000001  # 'LIVE' v1
+WINDOW_SECONDS = 300
+MAX_SLOTS = 64
+MAX_INSTITUCIONES = 1024
+NAME_BYTES = 128
+HLL_P = 14
+HLL_M = 1 << HLL_P
+SEED_RETRY_INTERVAL = 30.0
+
+SIN_INSTITUCION = 'Sin institución'
+OTRAS = 'Otras'
+OTRAS_IDX = MAX_INSTITUCIONES - 1
+
+# Offsets dentro del segmento (en palabras de 8 bytes salvo los *_BYTES/OFFSET)
+HEADER_WORDS = 2
+RING_SECS = 2
+RING_COUNTS = RING_SECS + WINDOW_SECONDS
+INST_COUNTS = RING_COUNTS + WINDOW_SECONDS
+SLOT_WORDS = INST_COUNTS + MAX_INSTITUCIONES
+SLOT_BYTES = SLOT_WORDS * 8 + HLL_M
+NAMES_OFFSET = HEADER_WORDS * 8
+SLOTS_OFFSET = NAMES_OFFSET + MAX_INSTITUCIONES * NAME_BYTES
+SIZE = SLOTS_OFFSET + MAX_SLOTS * SLOT_BYTES
+
+_HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_M)
+_HLL_POTENCIAS = [2.0 ** -r for r in range(65)]
+
+LiveSnapshot = namedtuple('LiveSnapshot', ['total', 'ultimos_5_min', 'emails_unicos', 'por_institucion'])
+
+
+def _epoch(timestamp):
+    """Segundos UTC de un timestamp de la base (str o datetime; sin zona = UTC)"""
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.fromisoformat(str(timestamp))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def _hll_hash(email_id):
+    """(registro, rango) de HyperLogLog para un email_id"""
+    h = int.from_bytes(hashlib.blake2b(email_id.encode(), digest_size=8).digest(), 'big')
+    resto = h & ((1 << (64 - HLL_P)) - 1)
+    return h >> (64 - HLL_P), (64 - HLL_P) - resto.bit_length() + 1
+
+
+def _hll_estimate(registros):
+    estimado = _HLL_ALPHA * HLL_M * HLL_M / sum(_HLL_POTENCIAS[r] for r in registros)
+    ceros = registros.count(0)
+    if estimado <= 2.5 * HLL_M and ceros:
+        # Rango bajo: conteo lineal
+        estimado = HLL_M * math.log(HLL_M / ceros)
+    return int(round(estimado))
+
+
+def _nombre_bytes(institucion):
+    """Nombre en utf-8 recortado a NAME_BYTES sin cortar un carácter"""
+    return institucion.encode()[:NAME_BYTES].decode(errors='ignore').encode()
+
+
+def _vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LiveCounters:
+    """
+    Contadores de aperturas compartidos entre procesos. record_open() se
+    llama desde el pixel de tracking; snapshot() arma las cifras del
+    dashboard. Si la memoria compartida no está disponible ambos quedan
+    inactivos y snapshot() devuelve None.
+    """
+
+    def __init__(self, repo, name='itseia_live'):
+        self.repo = repo
+        self.name = name
+        self.disponible = False
+        self._retry_at = None
+        self._lock_path = os.path.join(tempfile.gettempdir(), f'{name}.lock')
+        self._lock = threading.Lock()
+        self._pid = None
+        self._shm = None
+        self._words = None
+        self._bytes = None
+        self._slot = None
+        self._indices = {}
+        self._nombres = [SIN_INSTITUCION]
+
+    def record_open(self, email_id, institucion, timestamp=None):
+        """Suma una apertura; timestamp (de la base) para eventos con retraso"""
+        if not self._ensure_attached():
+            return
+        ahora = int(time.time())
+        segundo = ahora if timestamp is None else min(_epoch(timestamp), ahora)
+        with self._lock:
+            if institucion is None:
+                idx = 0
+            else:
+                idx = self._indices.get(institucion)
+                if idx is None:
+                    with self._file_lock():
+                        idx = self._registrar(institucion)
+                    self._indices[institucion] = idx
+            self._add(self._slot, idx, email_id, segundo, ahora)
+
+    def snapshot(self):
+        """Suma de todos los slots, o None si los contadores están inactivos"""
+        if not self._ensure_attached():
+            return None
+        w = self._words
+        ahora = int(time.time())
+        desde = ahora - WINDOW_SECONDS
+        n_nombres = w[1]
+        total = ventana = 0
+        por_institucion = [0] * MAX_INSTITUCIONES
+        registros = []
+        for slot in range(MAX_SLOTS):
+            base = self._slot_base(slot)
+            if w[base] == 0:
+                continue
+            total += w[base + 1]
+            segundos = w[base + RING_SECS:base + RING_COUNTS].tolist()
+            conteos = w[base + RING_COUNTS:base + INST_COUNTS].tolist()
+            ventana += sum(n for t, n in zip(segundos, conteos) if desde < t <= ahora)
+            for i, n in enumerate(w[base + INST_COUNTS:base + INST_COUNTS + n_nombres].tolist()):
+                por_institucion[i] += n
+            por_institucion[OTRAS_IDX] += w[base + INST_COUNTS + OTRAS_IDX]
+            hll = self._hll_offset(slot)
+            registros.append(self._bytes[hll:hll + HLL_M])
+
+        combinados = bytes(map(max, *registros)) if len(registros) > 1 else bytes(registros[0])
+        self._cargar_nombres(n_nombres)
+        conteos = {self._nombres[i]: n for i, n in enumerate(por_institucion[:n_nombres]) if n}
+        if por_institucion[OTRAS_IDX]:
+            conteos[OTRAS] = por_institucion[OTRAS_IDX]
+        return LiveSnapshot(
+            total=total,
+            ultimos_5_min=ventana,
+            emails_unicos=_hll_estimate(combinados) if total else 0,
+            por_institucion=dict(sorted(conteos.items(), key=lambda item: item[1], reverse=True)),
+        )
+
+    def unlink(self):
+        """Suelta y borra el segmento (para bases descartables, p. ej. benchmarks)"""
+        self.close()
+        try:
+            shm = shared_memory.SharedMemory(self.name)
+        except FileNotFoundError:
+            return
+        # unlink() también lo quita del resource_tracker
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        """Suelta la memoria compartida de este proceso (el segmento sigue existiendo)"""
+        with self._lock:
+            if self._shm is None:
+                return
+            self._words.release()
+            self._words = self._bytes = None
+            self._shm.close()
+            self._shm = None
+            self._pid = None
+            self.disponible = False
+
+    # --- Segmento compartido --------------------------------------------
+
+    def _ensure_attached(self):
+        # Cada worker de gunicorn reclama su propio slot (no se hereda en el fork)
+        if not self._debe_conectar():
+            return self.disponible
+        with self._lock:
+            if self._debe_conectar():
+                self._retry_at = None
+                try:
+                    self.disponible = self._attach()
+                except OSError as e:
+                    print(f"⚠️ Contadores en vivo deshabilitados: {e}")
+                    self.disponible = False
+                else:
+                    if not self.disponible:
+                        self._retry_at = time.monotonic() + SEED_RETRY_INTERVAL
+                self._pid = os.getpid()
+        return self.disponible
+
+    def _debe_conectar(self):
+        if self._pid != os.getpid():
+            return True
+        return self._retry_at is not None and time.monotonic() >= self._retry_at
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _attach(self):
+        """Conecta al segmento y reclama un slot; False si no se pudo sembrar"""
+        if fcntl is None:
+            raise OSError('fcntl no disponible en esta plataforma')
+        with self._file_lock():
+            try:
+                shm = shared_memory.SharedMemory(self.name, create=True, size=SIZE)
+            except FileExistsError:
+                shm = shared_memory.SharedMemory(self.name)
+                if shm.size < SIZE:
+                    # Segmento de una versión con otra disposición
+                    shm.close()
+                    shm.unlink()
+                    shm = shared_memory.SharedMemory(self.name, create=True, size=SIZE)
+            # Antes de Python 3.13 el resource_tracker borra el segmento cuando
+            # termina cualquier proceso que lo abrió; debe sobrevivir a los workers
+            resource_tracker.unregister(shm._name, 'shared_memory')
+
+            if self._words is not None:
+                # Vistas heredadas del proceso padre tras un fork
+                self._words.release()
+            self._shm = shm
+            self._bytes = shm.buf
+            self._words = shm.buf[:SIZE].cast('q')
+            self._indices = {}
+            self._nombres = [SIN_INSTITUCION]
+
+            if self._words[0] != MAGIC or not self._procesos_vivos():
+                if not self._reset():
+                    return False
+            self._slot = self._claim_slot()
+            return True
+
+    def _procesos_vivos(self):
+        return any(pid > 0 and _vivo(pid)
+                   for pid in (self._words[self._slot_base(slot)] for slot in range(1, MAX_SLOTS)))
+
+    def _reset(self):
+        w = self._words
+        w[0] = 0
+        self._bytes[:SIZE] = bytes(SIZE)
+        w[1] = 1
+        if not self._seed():
+            # Sin MAGIC: el próximo intento (de cualquier proceso) vuelve a sembrar
+            return False
+        w[0] = MAGIC
+        return True
+
+    def _seed(self):
+        """Carga en el slot 0 lo que ya está en la base de datos; False si falló"""
+        self._words[self._slot_base(0)] = -1
+        ahora = int(time.time())
+        desde = datetime.fromtimestamp(ahora - WINDOW_SECONDS + 1, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            por_institucion = self.repo.open_counts_by_institucion()
+            recientes = self.repo.open_counts_since(desde)
+            registros = bytearray(HLL_M)
+            for email_id in self.repo.iter_open_email_ids():
+                j, rango = _hll_hash(email_id)
+                if registros[j] < rango:
+                    registros[j] = rango
+        except Exception as e:
+            print(f"⚠️ No se pudieron sembrar los contadores en vivo, se reintentará: {e}")
+            return False
+
+        w = self._words
+        base = self._slot_base(0)
+        for institucion, n in por_institucion:
+            idx = 0 if institucion is None else self._registrar(institucion)
+            w[base + 1] += n
+            w[base + INST_COUNTS + idx] += n
+        for timestamp, n in recientes:
+            segundo = _epoch(timestamp)
+            if ahora - WINDOW_SECONDS < segundo <= ahora:
+                i = segundo % WINDOW_SECONDS
+                w[base + RING_SECS + i] = segundo
+                w[base + RING_COUNTS + i] += n
+        hll = self._hll_offset(0)
+        self._bytes[hll:hll + HLL_M] = registros
+        print(f"📈 Contadores en vivo sembrados: {w[base + 1]} aperturas")
+        return True
+
+    def _claim_slot(self):
+        """Slot de este proceso: uno libre o el de un worker que ya terminó"""
+        w = self._words
+        pid = os.getpid()
+        libre = None
+        for slot in range(1, MAX_SLOTS):
+            actual = w[self._slot_base(slot)]
+            if actual == pid:
+                return slot
+            if libre is None and (actual == 0 or not _vivo(actual)):
+                libre = slot
+        if libre is None:
+            raise OSError(f'no quedan slots libres ({MAX_SLOTS - 1} procesos)')
+        # El slot conserva los conteos del worker anterior: siguen sumando
+        w[self._slot_base(libre)] = pid
+        return libre
+
+    def _registrar(self, institucion):
+        """Índice de la institución en la tabla compartida (requiere el flock)"""
+        nombre = _nombre_bytes(institucion)
+        n_nombres = self._words[1]
+        for i in range(1, n_nombres):
+            offset = NAMES_OFFSET + i * NAME_BYTES
+            if self._bytes[offset:offset + NAME_BYTES].tobytes().rstrip(b'\0') == nombre:
+                return i
+        if n_nombres >= OTRAS_IDX:
+            return OTRAS_IDX
+        offset = NAMES_OFFSET + n_nombres * NAME_BYTES
+        self._bytes[offset:offset + len(nombre)] = nombre
+        # El nombre queda escrito antes de que los lectores vean el nuevo total
+        self._words[1] = n_nombres + 1
+        return n_nombres
+
+    def _cargar_nombres(self, n_nombres):
+        for i in range(len(self._nombres), n_nombres):
+            offset = NAMES_OFFSET + i * NAME_BYTES
+            self._nombres.append(self._bytes[offset:offset + NAME_BYTES].tobytes().rstrip(b'\0').decode())
+
+    def _add(self, slot, idx, email_id, segundo, ahora):
+        w = self._words
+        base = self._slot_base(slot)
+        w[base + 1] += 1
+        if ahora - WINDOW_SECONDS < segundo <= ahora:
+            i = segundo % WINDOW_SECONDS
+            anterior = w[base + RING_SECS + i]
+            if anterior < segundo:
+                # Bucket de una vuelta anterior del ring: se reinicia
+                w[base + RING_COUNTS + i] = 0
+                w[base + RING_SECS + i] = segundo
+            if anterior <= segundo:
+                w[base + RING_COUNTS + i] += 1
+        w[base + INST_COUNTS + idx] += 1
+        j, rango = _hll_hash(email_id)
+        hll = self._hll_offset(slot) + j
+        if self._bytes[hll] < rango:
+            self._bytes[hll] = rango
+
+    @staticmethod
+    def _slot_base(slot):
+        return (SLOTS_OFFSET + slot * SLOT_BYTES) // 8
+
+    @staticmethod
+    def _hll_offset(slot):
+        return SLOTS_OFFSET + slot * SLOT_BYTES + SLOT_WORDS * 8
@@ -0,0 +1,924 @@
+#!/usr/bin/env python3
+"""
+Capa de acceso a datos - Alianza ITSEIA-BYS
+Un único punto con todo el SQL de la aplicación; oculta el dialecto.
+
+- PostgreSQL: pool de conexiones persistentes y sentencias preparadas en el
+  servidor (PREPARE / EXECUTE), preparadas una vez por conexión.
+- SQLite: una conexión persistente por hilo, así el caché de sentencias de
+  sqlite3 (cached_statements) se reutiliza entre requests.
+
+Las filas se devuelven como tuplas (namedtuple), no como dicts.
+"""
+
+import csv
+import io
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+OpenRow = namedtuple('OpenRow', ['email_id', 'institucion', 'timestamp', 'ip', 'user_agent'])
+ConversionRow = namedtuple('ConversionRow', ['email_id', 'institucion', 'first_open_at', 'form_at', 't_form'])
+RecipientMatch = namedtuple('RecipientMatch', ['email_id', 'institucion', 'opens', 'last_open_at', 'form_at'])
+FormMatch = namedtuple('FormMatch', ['id', 'nombre', 'email', 'institucion', 'timestamp', 'email_id'])
+FunnelSummary = namedtuple('FunnelSummary', ['total', 'enviados', 'abiertos', 'clicks', 'formularios',
+                                             'avg_open', 'avg_form', 'n_open', 'n_form',
+                                             'median_open', 'median_form'])
+
+# Columnas de las tablas de eventos (orden de las tuplas que recibe insert_events)
+OPEN_COLUMNS = ('email_id', 'institucion', 'timestamp', 'ip_address', 'user_agent', 'campaign_id', 'recipient_id')
+CLICK_COLUMNS = ('email_id', 'token', 'url', 'timestamp', 'ip_address', 'user_agent')
+FORM_COLUMNS = ('nombre', 'email', 'institucion', 'telefono', 'dia', 'horario', 'timestamp', 'email_id')
+FUNNEL_COLUMNS = ('email_id', 'institucion', 'sent_at', 'first_open_at', 'last_open_at', 'opens',
+                  'first_click_at', 'clicks', 'form_at')
+ESP_EVENT_COLUMNS = ('provider', 'event_id', 'event_type', 'email_id', 'timestamp', 'url', 'ip_address', 'user_agent')
+
+# Segundos entre dos timestamps, por dialecto
+EPOCH_DIFF = {
+    'postgres': 'EXTRACT(EPOCH FROM ({fin} - {inicio}))',
+    'sqlite': '(julianday({fin}) - julianday({inicio})) * 86400',
+}
+
+# Funnel con tiempos derivados (se inserta como subconsulta en los reportes)
+FUNNEL_BASE = '''
+    SELECT email_id, institucion, sent_at, first_open_at, first_click_at, form_at,
+           {t_open} AS t_open,
+           {t_form} AS t_form
+    FROM recipient_funnel
+'''
+
+
+def _earliest(columna):
+    """Upsert del funnel: el menor timestamp entre el guardado y el nuevo"""
+    return (f'CASE WHEN recipient_funnel.{columna} IS NULL OR excluded.{columna} < recipient_funnel.{columna} '
+            f'THEN excluded.{columna} ELSE recipient_funnel.{columna} END')
+
+
+def _latest(columna):
+    """Upsert del funnel: el mayor timestamp (los eventos de proveedores llegan desordenados)"""
+    return (f'CASE WHEN recipient_funnel.{columna} IS NULL OR excluded.{columna} > recipient_funnel.{columna} '
+            f'THEN excluded.{columna} ELSE recipient_funnel.{columna} END')
+
+
+# Sentencias de la aplicación. Se escriben con '?' y se traducen al dialecto:
+# en PostgreSQL se preparan como $1..$n, en SQLite se usan tal cual.
+STATEMENTS = {
+    'insert_open': f'''
+        INSERT INTO email_opens ({', '.join(OPEN_COLUMNS)})
+        VALUES ({', '.join('?' * len(OPEN_COLUMNS))})
+    ''',
+    'insert_click': f'''
+        INSERT INTO email_clicks ({', '.join(CLICK_COLUMNS)})
+        VALUES ({', '.join('?' * len(CLICK_COLUMNS))})
+    ''',
+    'insert_form': '''
+        INSERT INTO formulario_contacto (nombre, email, institucion, telefono, dia, horario, timestamp, email_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'insert_link': 'INSERT INTO email_links (token, url) VALUES (?, ?)',
+    'list_links': 'SELECT token, url FROM email_links',
+    'count_opens': 'SELECT COUNT(*) FROM email_opens',
+    'count_unique_emails': 'SELECT COUNT(DISTINCT email_id) FROM email_opens',
+    # Siembra de los contadores en vivo (live_counters.py)
+    'count_opens_by_institucion': 'SELECT institucion, COUNT(*) FROM email_opens GROUP BY institucion',
+    'count_opens_since': 'SELECT timestamp, COUNT(*) FROM email_opens WHERE timestamp >= ? GROUP BY timestamp',
+    'list_open_email_ids': 'SELECT DISTINCT email_id FROM email_opens',
+    'list_opens': '''
+        SELECT email_id, institucion, timestamp, ip_address, user_agent
+        FROM email_opens
+        ORDER BY timestamp DESC
+    ''',
+    # Upserts incrementales de recipient_funnel
+    'funnel_open': f'''
+        INSERT INTO recipient_funnel (email_id, institucion, first_open_at, last_open_at, opens)
+        VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT (email_id) DO UPDATE SET
+            institucion = COALESCE(recipient_funnel.institucion, excluded.institucion),
+            first_open_at = {_earliest('first_open_at')},
+            last_open_at = {_latest('last_open_at')},
+            opens = recipient_funnel.opens + 1
+    ''',
+    'funnel_click': f'''
+        INSERT INTO recipient_funnel (email_id, first_click_at, clicks)
+        VALUES (?, ?, 1)
+        ON CONFLICT (email_id) DO UPDATE SET
+            first_click_at = {_earliest('first_click_at')},
+            clicks = recipient_funnel.clicks + 1
+    ''',
+    'funnel_form': f'''
+        INSERT INTO recipient_funnel (email_id, institucion, form_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (email_id) DO UPDATE SET
+            institucion = COALESCE(recipient_funnel.institucion, excluded.institucion),
+            form_at = {_earliest('form_at')}
+    ''',
+    'funnel_send': f'''
+        INSERT INTO recipient_funnel (email_id, institucion, sent_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (email_id) DO UPDATE SET
+            institucion = COALESCE(recipient_funnel.institucion, excluded.institucion),
+            sent_at = {_earliest('sent_at')}
+    ''',
+    'funnel_summary': f'''
+        SELECT COUNT(*), COUNT(sent_at), COUNT(first_open_at), COUNT(first_click_at),
+               COUNT(form_at), AVG(t_open), AVG(t_form), COUNT(t_open), COUNT(t_form)
+        FROM ({FUNNEL_BASE}) b
+    ''',
+    'funnel_median_open': f'''
+        SELECT AVG(t) FROM (
+            SELECT t_open AS t,
+                   ROW_NUMBER() OVER (ORDER BY t_open) AS rn,
+                   COUNT(*) OVER () AS n
+            FROM ({FUNNEL_BASE}) b
+            WHERE t_open IS NOT NULL
+        ) r
+        WHERE rn IN ((n + 1) / 2, (n + 2) / 2)
+    ''',
+    'funnel_median_form': f'''
+        SELECT AVG(t) FROM (
+            SELECT t_form AS t,
+                   ROW_NUMBER() OVER (ORDER BY t_form) AS rn,
+                   COUNT(*) OVER () AS n
+            FROM ({FUNNEL_BASE}) b
+            WHERE t_form IS NOT NULL
+        ) r
+        WHERE rn IN ((n + 1) / 2, (n + 2) / 2)
+    ''',
+    'funnel_conversions': f'''
+        SELECT email_id, institucion, first_open_at, form_at, t_form
+        FROM ({FUNNEL_BASE}) b
+        WHERE form_at IS NOT NULL
+        ORDER BY form_at DESC
+        LIMIT ?
+    ''',
+}
+
+# Reconstrucción del funnel desde los eventos crudos con funciones de ventana
+REBUILD_FUNNEL = (
+    '''
+    INSERT INTO recipient_funnel (email_id, institucion, first_open_at, last_open_at, opens)
+    SELECT email_id, institucion, timestamp, last_ts, n FROM (
+        SELECT email_id, institucion, timestamp,
+               ROW_NUMBER() OVER w AS rn,
+               COUNT(*) OVER (PARTITION BY email_id) AS n,
+               MAX(timestamp) OVER (PARTITION BY email_id) AS last_ts
+        FROM email_opens
+        WINDOW w AS (PARTITION BY email_id ORDER BY timestamp)
+    ) o WHERE rn = 1
+    ON CONFLICT (email_id) DO UPDATE SET
+        institucion = COALESCE(recipient_funnel.institucion, excluded.institucion),
+        first_open_at = excluded.first_open_at,
+        last_open_at = excluded.last_open_at,
+        opens = excluded.opens
+    ''',
+    '''
+    INSERT INTO recipient_funnel (email_id, first_click_at, clicks)
+    SELECT email_id, timestamp, n FROM (
+        SELECT email_id, timestamp,
+               ROW_NUMBER() OVER (PARTITION BY email_id ORDER BY timestamp) AS rn,
+               COUNT(*) OVER (PARTITION BY email_id) AS n
+        FROM email_clicks
+        WHERE email_id IS NOT NULL
+    ) k WHERE rn = 1
+    ON CONFLICT (email_id) DO UPDATE SET
+        first_click_at = excluded.first_click_at,
+        clicks = excluded.clicks
+    ''',
+    '''
+    INSERT INTO recipient_funnel (email_id, institucion, form_at)
+    SELECT email_id, institucion, timestamp FROM (
+        SELECT email_id, institucion, timestamp,
+               ROW_NUMBER() OVER (PARTITION BY email_id ORDER BY timestamp) AS rn
+        FROM formulario_contacto
+        WHERE email_id IS NOT NULL
+    ) f WHERE rn = 1
+    ON CONFLICT (email_id) DO UPDATE SET
+        institucion = COALESCE(recipient_funnel.institucion, excluded.institucion),
+        form_at = excluded.form_at
+    ''',
+)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS email_opens (
+        id {pk},
+        email_id TEXT NOT NULL,
+        institucion TEXT,
+        autoridad TEXT,
+        timestamp {ts} DEFAULT CURRENT_TIMESTAMP,
+        ip_address TEXT,
+        user_agent TEXT,
+        campaign_id INTEGER,
+        recipient_id INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS formulario_contacto (
+        id {pk},
+        nombre TEXT NOT NULL,
+        email TEXT NOT NULL,
+        institucion TEXT,
+        telefono TEXT,
+        dia TEXT,
+        horario TEXT,
+        timestamp {ts} DEFAULT CURRENT_TIMESTAMP,
+        email_id TEXT
+    );
+    CREATE TABLE IF NOT EXISTS email_links (
+        token TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        created_at {ts} DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS email_clicks (
+        id {pk},
+        email_id TEXT,
+        token TEXT NOT NULL,
+        url TEXT NOT NULL,
+        timestamp {ts} DEFAULT CURRENT_TIMESTAMP,
+        ip_address TEXT,
+        user_agent TEXT
+    );
+    CREATE TABLE IF NOT EXISTS recipient_funnel (
+        email_id TEXT PRIMARY KEY,
+        institucion TEXT,
+        sent_at {ts},
+        first_open_at {ts},
+        last_open_at {ts},
+        opens INTEGER NOT NULL DEFAULT 0,
+        first_click_at {ts},
+        clicks INTEGER NOT NULL DEFAULT 0,
+        form_at {ts}
+    );
+    CREATE TABLE IF NOT EXISTS esp_events (
+        provider TEXT NOT NULL,
+        event_id TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        email_id TEXT NOT NULL,
+        timestamp {ts} NOT NULL,
+        url TEXT,
+        ip_address TEXT,
+        user_agent TEXT,
+        PRIMARY KEY (provider, event_id)
+    )
+'''
+
+# Tabla temporal (por conexión) donde se carga cada lote antes de deduplicar
+INGEST_STAGING = {
+    'postgres': '''
+        CREATE TEMP TABLE IF NOT EXISTS ingest_staging (
+            provider TEXT, event_id TEXT, event_type TEXT, email_id TEXT,
+            timestamp TIMESTAMP, url TEXT, ip_address TEXT, user_agent TEXT
+        ) ON COMMIT DELETE ROWS
+    ''',
+    'sqlite': '''
+        CREATE TEMP TABLE IF NOT EXISTS ingest_staging (
+            provider TEXT, event_id TEXT, event_type TEXT, email_id TEXT,
+            timestamp DATETIME, url TEXT, ip_address TEXT, user_agent TEXT
+        )
+    ''',
+}
+
+# Pasa del staging a esp_events; solo devuelve los eventos que no existían
+INGEST_MERGE = f'''
+    INSERT INTO esp_events ({', '.join(ESP_EVENT_COLUMNS)})
+    SELECT {', '.join(ESP_EVENT_COLUMNS)} FROM ingest_staging WHERE true
+    ON CONFLICT (provider, event_id) DO NOTHING
+    RETURNING provider, event_id
+'''
+
+# Columnas agregadas después de la primera versión del esquema
+MIGRATIONS = (
+    ('email_opens', 'campaign_id', 'INTEGER'),
+    ('email_opens', 'recipient_id', 'INTEGER'),
+    ('formulario_contacto', 'email_id', 'TEXT'),
+)
+
+# Índices que soportan el funnel (reconstrucción por ventana y reportes)
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_email_opens_email_ts ON email_opens (email_id, timestamp)',
+    # list_opens (ORDER BY timestamp DESC) y la siembra de los contadores en vivo (timestamp >= ?)
+    'CREATE INDEX IF NOT EXISTS idx_email_opens_timestamp ON email_opens (timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_email_clicks_email_ts ON email_clicks (email_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_formulario_email_ts ON formulario_contacto (email_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_funnel_first_open ON recipient_funnel (first_open_at)',
+    'CREATE INDEX IF NOT EXISTS idx_funnel_form ON recipient_funnel (form_at)',
+)
+
+# Búsqueda (/search). Destinatarios: sobre recipient_funnel (una fila por
+# email_id con su institución), no sobre cada apertura. Parámetros comunes:
+# prefijo ('texto%'), contiene ('%texto%'), limit, offset.
+SEARCH_SCHEMA = {
+    'postgres': (
+        # En el esquema public y calificado: los shards por esquema (search_path=shard_x)
+        # comparten la extensión sin tener public en su search_path
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public',
+        'CREATE INDEX IF NOT EXISTS idx_funnel_institucion_trgm '
+        'ON recipient_funnel USING gin (institucion public.gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS idx_funnel_email_id_trgm '
+        'ON recipient_funnel USING gin (email_id public.gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS idx_formulario_nombre_trgm '
+        'ON formulario_contacto USING gin (nombre public.gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS idx_formulario_email_trgm '
+        'ON formulario_contacto USING gin (email public.gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS idx_formulario_institucion_trgm '
+        'ON formulario_contacto USING gin (institucion public.gin_trgm_ops)',
+    ),
+    'sqlite': (
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS recipient_funnel_fts USING fts5(
+            email_id, institucion, content='recipient_funnel', tokenize='trigram')''',
+        '''CREATE TRIGGER IF NOT EXISTS recipient_funnel_fts_ai AFTER INSERT ON recipient_funnel BEGIN
+            INSERT INTO recipient_funnel_fts (rowid, email_id, institucion)
+            VALUES (new.rowid, new.email_id, new.institucion);
+        END''',
+        # Los upserts del funnel tocan institucion en cada evento: solo reindexar si cambió
+        '''CREATE TRIGGER IF NOT EXISTS recipient_funnel_fts_au AFTER UPDATE OF institucion ON recipient_funnel
+        WHEN old.institucion IS NOT new.institucion BEGIN
+            INSERT INTO recipient_funnel_fts (recipient_funnel_fts, rowid, email_id, institucion)
+            VALUES ('delete', old.rowid, old.email_id, old.institucion);
+            INSERT INTO recipient_funnel_fts (rowid, email_id, institucion)
+            VALUES (new.rowid, new.email_id, new.institucion);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS recipient_funnel_fts_ad AFTER DELETE ON recipient_funnel BEGIN
+            INSERT INTO recipient_funnel_fts (recipient_funnel_fts, rowid, email_id, institucion)
+            VALUES ('delete', old.rowid, old.email_id, old.institucion);
+        END''',
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS formulario_fts USING fts5(
+            nombre, email, institucion, content='formulario_contacto', content_rowid='id', tokenize='trigram')''',
+        '''CREATE TRIGGER IF NOT EXISTS formulario_fts_ai AFTER INSERT ON formulario_contacto BEGIN
+            INSERT INTO formulario_fts (rowid, nombre, email, institucion)
+            VALUES (new.id, new.nombre, new.email, new.institucion);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS formulario_fts_ad AFTER DELETE ON formulario_contacto BEGIN
+            INSERT INTO formulario_fts (formulario_fts, rowid, nombre, email, institucion)
+            VALUES ('delete', old.id, old.nombre, old.email, old.institucion);
+        END''',
+    ),
+}
+
+# Índices FTS5 a reconstruir cuando se crean sobre datos existentes
+SEARCH_FTS_TABLES = ('recipient_funnel_fts', 'formulario_fts')
+
+DIALECT_STATEMENTS = {
+    'postgres': {
+        # Orden: coincidencias por prefijo, similitud de trigramas, recencia
+        'search_recipients': '''
+            SELECT email_id, institucion, opens, last_open_at, form_at
+            FROM recipient_funnel
+            WHERE institucion ILIKE ? OR email_id ILIKE ?
+            ORDER BY (institucion ILIKE ? OR email_id ILIKE ?) DESC,
+                     GREATEST(public.similarity(COALESCE(institucion, ''), ?), public.similarity(email_id, ?)) DESC,
+                     last_open_at DESC NULLS LAST
+            LIMIT ? OFFSET ?
+        ''',
+        'search_forms': '''
+            SELECT id, nombre, email, institucion, timestamp, email_id
+            FROM formulario_contacto
+            WHERE nombre ILIKE ? OR email ILIKE ? OR institucion ILIKE ?
+            ORDER BY (nombre ILIKE ? OR email ILIKE ? OR institucion ILIKE ?) DESC,
+                     GREATEST(public.similarity(nombre, ?), public.similarity(email, ?),
+                              public.similarity(COALESCE(institucion, ''), ?)) DESC,
+                     timestamp DESC
+            LIMIT ? OFFSET ?
+        ''',
+    },
+    'sqlite': {
+        # Orden: coincidencias por prefijo, bm25 del índice FTS5, recencia
+        'search_recipients': '''
+            SELECT r.email_id, r.institucion, r.opens, r.last_open_at, r.form_at
+            FROM recipient_funnel_fts f
+            JOIN recipient_funnel r ON r.rowid = f.rowid
+            WHERE recipient_funnel_fts MATCH ?
+            ORDER BY (r.institucion LIKE ? ESCAPE '\\' OR r.email_id LIKE ? ESCAPE '\\') DESC,
+                     f.rank, r.last_open_at DESC
+            LIMIT ? OFFSET ?
+        ''',
+        'search_forms': '''
+            SELECT c.id, c.nombre, c.email, c.institucion, c.timestamp, c.email_id
+            FROM formulario_fts f
+            JOIN formulario_contacto c ON c.id = f.rowid
+            WHERE formulario_fts MATCH ?
+            ORDER BY (c.nombre LIKE ? ESCAPE '\\' OR c.email LIKE ? ESCAPE '\\'
+                      OR c.institucion LIKE ? ESCAPE '\\') DESC,
+                     f.rank, c.timestamp DESC
+            LIMIT ? OFFSET ?
+        ''',
+        # Trigramas requieren 3+ caracteres: consultas cortas buscan solo por prefijo
+        'search_recipients_short': '''
+            SELECT email_id, institucion, opens, last_open_at, form_at
+            FROM recipient_funnel
+            WHERE institucion LIKE ? ESCAPE '\\' OR email_id LIKE ? ESCAPE '\\'
+            ORDER BY last_open_at DESC
+            LIMIT ? OFFSET ?
+        ''',
+        'search_forms_short': '''
+            SELECT id, nombre, email, institucion, timestamp, email_id
+            FROM formulario_contacto
+            WHERE nombre LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\' OR institucion LIKE ? ESCAPE '\\'
+            ORDER BY timestamp DESC
+            LIMIT ? OFFSET ?
+        ''',
+    },
+}
+
+
+# Tablas con filas por email_id que se mueven al rebalancear shards
+RECIPIENT_TABLES = {
+    'email_opens': OPEN_COLUMNS,
+    'email_clicks': CLICK_COLUMNS,
+    'formulario_contacto': FORM_COLUMNS,
+    'recipient_funnel': FUNNEL_COLUMNS,
+    'esp_events': ESP_EVENT_COLUMNS,
+}
+
+
+# Esquemas de URL de PostgreSQL (DATABASE_URL y shards)
+POSTGRES_SCHEMES = ('postgres://', 'postgresql://')
+
+
+def is_production(environ=os.environ):
+    """
+    Producción = PostgreSQL configurado, en DATABASE_URL o en algún shard de
+    SHARDS. Sin PostgreSQL es desarrollo local con SQLite.
+    """
+    if environ.get('DATABASE_URL'):
+        return True
+    return any(scheme in environ.get('SHARDS', '') for scheme in POSTGRES_SCHEMES)
+
+
+def _to_numbered(sql):
+    """Traduce placeholders '?' a $1..$n (sintaxis de PREPARE)"""
+    contador = iter(range(1, 1000))
+    return re.sub(r'\?', lambda _: f'${next(contador)}', sql)
+
+
+class Repository:
+    """
+    Acceso a datos con métodos tipados. Cada método público abre y cierra su
+    propia transacción.
+    """
+
+    def __init__(self, database_url=None, sqlite_path='email_tracking.db', pool_size=5, sslmode='require'):
+        self.database_url = database_url
+        self.sslmode = sslmode
+        self.sqlite_path = sqlite_path
+        self.pool_size = pool_size
+        self.dialect = 'postgres' if database_url else 'sqlite'
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+        self._pid = None
+        self._schema_ready = False
+
+        epoch = EPOCH_DIFF[self.dialect]
+        # Intervalos negativos (relojes o envíos mal registrados) quedan en NULL:
+        # no cuentan en promedios ni medianas
+        tiempos = {
+            't_open': f"CASE WHEN first_open_at >= sent_at THEN {epoch.format(fin='first_open_at', inicio='sent_at')} END",
+            't_form': f"CASE WHEN form_at >= first_open_at THEN {epoch.format(fin='form_at', inicio='first_open_at')} END",
+        }
+        statements = dict(STATEMENTS, **DIALECT_STATEMENTS[self.dialect])
+        self._sql = {}
+        for name, sql in statements.items():
+            sql = sql.replace('{t_open}', tiempos['t_open']).replace('{t_form}', tiempos['t_form'])
+            self._sql[name] = _to_numbered(sql) if self.dialect == 'postgres' else sql
+        # EXECUTE name (%s, ...) para cada sentencia preparada
+        self._execute_sql = {
+            name: f"EXECUTE {name} ({', '.join(['%s'] * sql.count('?'))})" if sql.count('?') else f'EXECUTE {name}'
+            for name, sql in statements.items()
+        }
+
+    # --- Conexiones -----------------------------------------------------
+
+    @contextmanager
+    def _transaction(self, cursor_name=None):
+        """
+        Entrega un cursor dentro de una transacción; commit al salir.
+        cursor_name (solo PostgreSQL) crea un cursor del lado del servidor.
+        """
+        if self.dialect == 'postgres':
+            pool = self._get_pool()
+            conn = pool.getconn()
+            roto = False
+            try:
+                with conn.cursor(name=cursor_name) as cur:
+                    yield cur
+                conn.commit()
+            except BaseException as e:
+                # BaseException: un generador abandonado (GeneratorExit) también hace rollback.
+                # Conexiones caídas se descartan del pool en vez de reutilizarse
+                roto = bool(conn.closed) or isinstance(e, (self._pg.OperationalError, self._pg.InterfaceError))
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                pool.putconn(conn, close=roto)
+        else:
+            conn = self._sqlite_conn()
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def _get_pool(self):
+        # El pool no sobrevive a fork: uno por worker de gunicorn
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    import psycopg2
+                    import psycopg2.extensions
+                    from psycopg2.pool import ThreadedConnectionPool
+
+                    class PreparedConnection(psycopg2.extensions.connection):
+                        """Conexión que recuerda qué sentencias ya preparó"""
+                        def __init__(self, *args, **kwargs):
+                            super().__init__(*args, **kwargs)
+                            self.prepared = set()
+
+                    self._pg = psycopg2
+                    self._pool = ThreadedConnectionPool(
+                        1, self.pool_size, self.database_url,
+                        sslmode=self.sslmode, connection_factory=PreparedConnection
+                    )
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _sqlite_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.sqlite_path, cached_statements=256)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Cierra las conexiones del hilo/proceso actual"""
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # --- Ejecución de sentencias ----------------------------------------
+
+    def _prepare(self, cur, name):
+        prepared = cur.connection.prepared
+        if name not in prepared:
+            cur.execute(f'PREPARE {name} AS {self._sql[name]}')
+            prepared.add(name)
+
+    def _execute(self, cur, name, params=()):
+        if self.dialect == 'postgres':
+            self._prepare(cur, name)
+            cur.execute(self._execute_sql[name], params)
+        else:
+            cur.execute(self._sql[name], params)
+
+    def _executemany(self, cur, name, rows):
+        if not rows:
+            return
+        if self.dialect == 'postgres':
+            from psycopg2.extras import execute_batch
+            self._prepare(cur, name)
+            execute_batch(cur, self._execute_sql[name], rows)
+        else:
+            cur.executemany(self._sql[name], rows)
+
+    # --- Esquema --------------------------------------------------------
+
+    def init_schema(self):
+        """Crea tablas, aplica migraciones de columnas y crea índices"""
+        if self.dialect == 'postgres':
+            schema = SCHEMA.format(pk='SERIAL PRIMARY KEY', ts='TIMESTAMP')
+        else:
+            schema = SCHEMA.format(pk='INTEGER PRIMARY KEY AUTOINCREMENT', ts='DATETIME')
+
+        with self._transaction() as cur:
+            for ddl in schema.split(';'):
+                cur.execute(ddl)
+            for tabla, columna, tipo in MIGRATIONS:
+                if self.dialect == 'postgres':
+                    cur.execute(f'ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS {columna} {tipo}')
+                else:
+                    cur.execute(f'PRAGMA table_info({tabla})')
+                    if columna not in {row[1] for row in cur.fetchall()}:
+                        cur.execute(f'ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}')
+            for index_sql in INDEXES:
+                cur.execute(index_sql)
+
+            nuevos_fts = []
+            if self.dialect == 'sqlite':
+                cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                existentes = {row[0] for row in cur.fetchall()}
+                nuevos_fts = [t for t in SEARCH_FTS_TABLES if t not in existentes]
+            for ddl in SEARCH_SCHEMA[self.dialect]:
+                cur.execute(ddl)
+            # Índices FTS recién creados sobre tablas con datos: indexar lo existente
+            for tabla in nuevos_fts:
+                cur.execute(f"INSERT INTO {tabla} ({tabla}) VALUES ('rebuild')")
+        self._schema_ready = True
+
+    def ensure_schema(self):
+        """init_schema() una sola vez por proceso"""
+        if not self._schema_ready:
+            self.init_schema()
+
+    # --- Escrituras -----------------------------------------------------
+
+    def insert_events(self, opens=(), clicks=()):
+        """
+        Inserta un lote de aperturas y clicks (tuplas en el orden de
+        OPEN_COLUMNS / CLICK_COLUMNS) y actualiza el funnel, en una transacción
+        """
+        with self._transaction() as cur:
+            self._insert_events(cur, opens, clicks)
+
+    def _insert_events(self, cur, opens, clicks):
+        self._executemany(cur, 'insert_open', opens)
+        self._executemany(cur, 'insert_click', clicks)
+        self._executemany(cur, 'funnel_open', [(o[0], o[1], o[2], o[2]) for o in opens])
+        self._executemany(cur, 'funnel_click', [(k[0], k[3]) for k in clicks if k[0] is not None])
+
+    def ingest_events(self, events):
+        """
+        Ingesta masiva de eventos de proveedores de email, idempotente por
+        (provider, event_id). Cada evento es una tupla con ESP_EVENT_COLUMNS
+        seguida de (institucion, campaign_id, recipient_id).
+        Carga con COPY (PostgreSQL) o executemany (SQLite) a una tabla
+        temporal y todo ocurre en una transacción. Devuelve los eventos nuevos
+        (los que no estaban ya en la base).
+        """
+        n = len(ESP_EVENT_COLUMNS)
+        por_clave = {}
+        for e in events:
+            # Duplicados dentro del mismo lote: gana el primero, igual que en la base
+            por_clave.setdefault((e[0], e[1]), e)
+
+        with self._transaction() as cur:
+            cur.execute(INGEST_STAGING[self.dialect])
+            if self.dialect == 'postgres':
+                buffer = io.StringIO()
+                # QUOTE_NONNUMERIC: None queda sin comillas (NULL), '' queda como ""
+                csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(e[:n] for e in por_clave.values())
+                buffer.seek(0)
+                cur.copy_expert(f"COPY ingest_staging ({', '.join(ESP_EVENT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                                buffer)
+            else:
+                cur.execute('DELETE FROM ingest_staging')
+                cur.executemany(f"INSERT INTO ingest_staging VALUES ({', '.join('?' * n)})",
+                                [e[:n] for e in por_clave.values()])
+
+            cur.execute(INGEST_MERGE)
+            nuevos = [por_clave[tuple(row)] for row in cur.fetchall()]
+
+            opens = []
+            clicks = []
+            for provider, _, tipo, email_id, timestamp, url, ip, ua, institucion, campaign, recipient in nuevos:
+                if tipo == 'open':
+                    opens.append((email_id, institucion, timestamp, ip, ua, campaign, recipient))
+                elif tipo == 'click':
+                    clicks.append((email_id, f'esp:{provider}', url, timestamp, ip, ua))
+            self._insert_events(cur, opens, clicks)
+
+            if self.dialect == 'sqlite':
+                cur.execute('DELETE FROM ingest_staging')
+
+        return nuevos
+
+    def insert_form(self, nombre, email, institucion, telefono, dia, horario, timestamp, email_id=None):
+        """Guarda un formulario de contacto y, si viene de un email, lo marca en el funnel"""
+        with self._transaction() as cur:
+            self._execute(cur, 'insert_form', (nombre, email, institucion, telefono, dia, horario,
+                                               timestamp, email_id))
+            if email_id is not None:
+                self._execute(cur, 'funnel_form', (email_id, institucion, timestamp))
+
+    def insert_link(self, token, url):
+        with self._transaction() as cur:
+            self._execute(cur, 'insert_link', (token, url))
+
+    def register_sends(self, rows):
+        """Marca envíos en el funnel: tuplas (email_id, institucion, timestamp)"""
+        with self._transaction() as cur:
+            self._executemany(cur, 'funnel_send', rows)
+
+    def rebuild_funnel(self):
+        with self._transaction() as cur:
+            for sql in REBUILD_FUNNEL:
+                cur.execute(sql)
+            if self.dialect == 'sqlite':
+                # El rowid de recipient_funnel puede cambiar con VACUUM
+                cur.execute("INSERT INTO recipient_funnel_fts (recipient_funnel_fts) VALUES ('rebuild')")
+
+    # --- Lecturas -------------------------------------------------------
+
+    def list_links(self):
+        with self._transaction() as cur:
+            self._execute(cur, 'list_links')
+            return cur.fetchall()
+
+    def stats_summary(self):
+        """(total de aperturas, emails únicos)"""
+        with self._transaction() as cur:
+            self._execute(cur, 'count_opens')
+            total = cur.fetchone()[0]
+            self._execute(cur, 'count_unique_emails')
+            unicos = cur.fetchone()[0]
+        return total, unicos
+
+    def list_opens(self):
+        with self._transaction() as cur:
+            self._execute(cur, 'list_opens')
+            return [OpenRow._make(row) for row in cur.fetchall()]
+
+    def iter_opens(self, batch_size=5000):
+        """
+        Mismas filas que list_opens, como tuplas crudas leídas del cursor por
+        bloques: sin namedtuple ni lista intermedia por fila
+        """
+        return self._iter_rows('list_opens', batch_size)
+
+    def _iter_rows(self, name, batch_size):
+        """
+        Filas de una sentencia sin parámetros, de a batch_size por vez. En
+        PostgreSQL un cursor normal trae todo el resultado al ejecutar: se usa
+        un cursor con nombre (DECLARE no admite EXECUTE, va el SQL directo).
+        """
+        if self.dialect == 'postgres':
+            with self._transaction(cursor_name=f'iter_{name}') as cur:
+                cur.execute(self._sql[name])
+                yield from self._fetch_batches(cur, batch_size)
+        else:
+            with self._transaction() as cur:
+                self._execute(cur, name)
+                yield from self._fetch_batches(cur, batch_size)
+
+    @staticmethod
+    def _fetch_batches(cur, batch_size):
+        while True:
+            filas = cur.fetchmany(batch_size)
+            if not filas:
+                break
+            yield from filas
+
+    def open_counts_by_institucion(self):
+        """[(institucion, aperturas)], con None para los IDs sin institución"""
+        with self._transaction() as cur:
+            self._execute(cur, 'count_opens_by_institucion')
+            return cur.fetchall()
+
+    def open_counts_since(self, since):
+        """[(timestamp, aperturas)] por segundo desde `since` ('YYYY-MM-DD HH:MM:SS' UTC)"""
+        with self._transaction() as cur:
+            self._execute(cur, 'count_opens_since', (since,))
+            return cur.fetchall()
+
+    def iter_open_email_ids(self, batch_size=5000):
+        """Los email_id distintos con aperturas, leídos por bloques"""
+        for fila in self._iter_rows('list_open_email_ids', batch_size):
+            yield fila[0]
+
+    def funnel_summary(self):
+        with self._transaction() as cur:
+            self._execute(cur, 'funnel_summary')
+            resumen = cur.fetchone()
+            self._execute(cur, 'funnel_median_open')
+            mediana_open = cur.fetchone()[0]
+            self._execute(cur, 'funnel_median_form')
+            mediana_form = cur.fetchone()[0]
+        return FunnelSummary(*resumen, mediana_open, mediana_form)
+
+    def funnel_conversions(self, limit=100):
+        with self._transaction() as cur:
+            self._execute(cur, 'funnel_conversions', (int(limit),))
+            return [ConversionRow._make(row) for row in cur.fetchall()]
+
+    def search_statements(self, texto, limit, offset):
+        """Sentencias y parámetros de search(): [(destinatarios), (formularios)]"""
+        escapado = texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        prefijo = f'{escapado}%'
+        contiene = f'%{escapado}%'
+
+        if self.dialect == 'postgres':
+            return [('search_recipients', (contiene, contiene, prefijo, prefijo, texto, texto, limit, offset)),
+                    ('search_forms', (contiene, contiene, contiene, prefijo, prefijo, prefijo,
+                                      texto, texto, texto, limit, offset))]
+        if len(texto) >= 3:
+            frase = '"' + texto.replace('"', '""') + '"'
+            return [('search_recipients', (frase, prefijo, prefijo, limit, offset)),
+                    ('search_forms', (frase, prefijo, prefijo, prefijo, limit, offset))]
+        return [('search_recipients_short', (prefijo, prefijo, limit, offset)),
+                ('search_forms_short', (prefijo, prefijo, prefijo, limit, offset))]
+
+    def search(self, texto, limit=20, offset=0):
+        """
+        Busca por prefijo o subcadena en destinatarios (institucion, email_id)
+        y formularios (nombre, email, institucion). Devuelve
+        (lista de RecipientMatch, lista de FormMatch), ya ordenadas por relevancia.
+        """
+        (nombre_dest, params_dest), (nombre_form, params_form) = self.search_statements(texto, limit, offset)
+        with self._transaction() as cur:
+            self._execute(cur, nombre_dest, params_dest)
+            destinatarios = cur.fetchall()
+            self._execute(cur, nombre_form, params_form)
+            formularios = cur.fetchall()
+
+        return ([RecipientMatch._make(row) for row in destinatarios],
+                [FormMatch._make(row) for row in formularios])
+
+    # --- Rebalanceo de shards -------------------------------------------
+
+    def list_recipient_ids(self):
+        """Todos los email_id con filas en este backend"""
+        union = ' UNION '.join(f'SELECT email_id FROM {tabla} WHERE email_id IS NOT NULL'
+                               for tabla in RECIPIENT_TABLES)
+        with self._transaction() as cur:
+            cur.execute(union)
+            return [row[0] for row in cur.fetchall()]
+
+    def _in_clause(self, email_ids):
+        marca = '%s' if self.dialect == 'postgres' else '?'
+        return f"email_id IN ({', '.join([marca] * len(email_ids))})"
+
+    def export_recipients(self, email_ids):
+        """Filas de RECIPIENT_TABLES para esos email_id: {tabla: [tuplas]}"""
+        datos = {}
+        with self._transaction() as cur:
+            for tabla, columnas in RECIPIENT_TABLES.items():
+                cur.execute(f"SELECT {', '.join(columnas)} FROM {tabla} WHERE {self._in_clause(email_ids)}",
+                            list(email_ids))
+                datos[tabla] = cur.fetchall()
+        return datos
+
+    def import_recipients(self, email_ids, datos):
+        """
+        Reemplaza las filas de esos email_id por `datos` en una transacción.
+        Borrar primero hace que repetir un rebalanceo interrumpido sea seguro.
+        """
+        marca = '%s' if self.dialect == 'postgres' else '?'
+        with self._transaction() as cur:
+            for tabla, columnas in RECIPIENT_TABLES.items():
+                cur.execute(f'DELETE FROM {tabla} WHERE {self._in_clause(email_ids)}', list(email_ids))
+                if datos.get(tabla):
+                    cur.executemany(
+                        f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join([marca] * len(columnas))})",
+                        datos[tabla]
+                    )
+
+    def delete_recipients(self, email_ids):
+        with self._transaction() as cur:
+            for tabla in RECIPIENT_TABLES:
+                cur.execute(f'DELETE FROM {tabla} WHERE {self._in_clause(email_ids)}', list(email_ids))
+
+    # --- Diagnóstico (benchmarks/query_plans.py) ------------------------
+
+    def statement_names(self):
+        return list(self._sql)
+
+    def analyze(self):
+        """Actualiza las estadísticas del planificador"""
+        with self._transaction() as cur:
+            cur.execute('ANALYZE')
+
+    def explain(self, name, params=()):
+        """
+        Plan de una sentencia: líneas de EXPLAIN QUERY PLAN en SQLite, el
+        plan JSON de EXPLAIN (FORMAT JSON) EXECUTE en PostgreSQL
+        """
+        with self._transaction() as cur:
+            if self.dialect == 'postgres':
+                self._prepare(cur, name)
+                cur.execute(f'EXPLAIN (FORMAT JSON) {self._execute_sql[name]}', params)
+                return cur.fetchone()[0]
+            cur.execute(f'EXPLAIN QUERY PLAN {self._sql[name]}', params)
+            return [row[3] for row in cur.fetchall()]
+
+    def explain_sql(self, sql, setup=()):
+        """
+        Como explain(), para SQL sin parámetros que no es sentencia preparada.
+        `setup` se ejecuta antes en la misma transacción (p. ej. tablas temporales)
+        """
+        with self._transaction() as cur:
+            for sentencia in setup:
+                cur.execute(sentencia)
+            if self.dialect == 'postgres':
+                cur.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+                return cur.fetchone()[0]
+            cur.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[3] for row in cur.fetchall()]
+
+    def timed(self, name, params=()):
+        """Ejecuta la sentencia (y lee todas sus filas); devuelve los segundos"""
+        with self._transaction() as cur:
+            inicio = time.perf_counter()
+            self._execute(cur, name, params)
+            if cur.description is not None:
+                cur.fetchall()
+            return time.perf_counter() - inicio
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Sharding por campaña - Alianza ITSEIA-BYS
+Reparte los datos entre N backends (archivos SQLite o bases/esquemas de
+PostgreSQL) según un hash de la campaña del email_id. Todas las filas de un
+mismo email_id viven en el mismo shard.
+
+Configuración (variable SHARDS, separada por comas, nombre opcional):
+    SHARDS="s0=sqlite:///shard0.db,s1=sqlite:///shard1.db"
+    SHARDS="a=postgresql://.../db?options=-csearch_path%3Dshard_a,b=postgresql://..."
+
+Se usa rendezvous hashing: al agregar un shard solo se mueve ~1/N de las
+campañas. Para moverlas:
+    SHARDS="..." python sharding.py rebalance [--dry-run]
+"""
+
+import hashlib
+import heapq
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, zip_longest
+
+import tracking_ids
+from repository import POSTGRES_SCHEMES, Repository, FunnelSummary
+
+REBALANCE_CHUNK = 500
+
+
+class ShardWriteError(Exception):
+    """
+    Falló la escritura en algunos shards. opens / clicks son solo las filas
+    de esos shards: los demás ya confirmaron y no deben reintentarse.
+    """
+
+    def __init__(self, errores, opens, clicks):
+        super().__init__('; '.join(f'{nombre}: {e}' for nombre, e in errores))
+        self.opens = opens
+        self.clicks = clicks
+
+
+def parse_shards(config):
+    """'nombre=url,...' -> [(nombre, Repository)]"""
+    shards = []
+    for i, entrada in enumerate(e.strip() for e in config.split(',') if e.strip()):
+        nombre, sep, url = entrada.partition('=')
+        if not sep or '://' in nombre:
+            nombre, url = f'shard{i}', entrada
+        if url.startswith('sqlite:///'):
+            repo = Repository(sqlite_path=url[len('sqlite:///'):])
+        elif url.startswith(POSTGRES_SCHEMES):
+            repo = Repository(database_url=url)
+        else:
+            raise ValueError(f'URL de shard no soportada: {url}')
+        shards.append((nombre, repo))
+    if not shards:
+        raise ValueError('SHARDS está vacío')
+    return shards
+
+
+@lru_cache(maxsize=65536)
+def campaign_key(email_id):
+    """Campaña del email_id: la firmada o, en IDs antiguos, el prefijo antes de '_'"""
+    try:
+        tid = tracking_ids.decode(email_id)
+    except tracking_ids.InvalidTrackingId:
+        tid = None
+    if tid is not None and tid.campaign is not None:
+        return f'campaign:{tid.campaign}'
+    return email_id.split('_', 1)[0]
+
+
+class ShardedRepository:
+    """
+    Misma interfaz que Repository, repartida entre shards. Las escrituras van
+    al shard de cada email_id; las lecturas se consultan en paralelo y se
+    combinan. Los links y los formularios sin email_id viven en el primer shard.
+    """
+
+    def __init__(self, shards):
+        self.names = [nombre for nombre, _ in shards]
+        self.shards = [repo for _, repo in shards]
+        self.dialect = self.shards[0].dialect
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard')
+
+    @property
+    def home(self):
+        return self.shards[0]
+
+    def shard_index(self, email_id):
+        """Rendezvous hashing: el shard con mayor hash(nombre, campaña)"""
+        if email_id is None:
+            return 0
+        key = campaign_key(email_id)
+        return max(range(len(self.names)), key=lambda i: hashlib.blake2b(
+            f'{self.names[i]}:{key}'.encode(), digest_size=8).digest())
+
+    def for_email(self, email_id):
+        return self.shards[self.shard_index(email_id)]
+
+    def _fan_out(self, fn):
+        """Ejecuta fn(repo) en todos los shards en paralelo"""
+        return list(self._executor.map(fn, self.shards))
+
+    def _group(self, filas, email_index=0):
+        grupos = defaultdict(list)
+        for fila in filas:
+            grupos[self.shard_index(fila[email_index])].append(fila)
+        return grupos
+
+    # --- Esquema --------------------------------------------------------
+
+    def init_schema(self):
+        self._fan_out(lambda r: r.init_schema())
+
+    def ensure_schema(self):
+        self._fan_out(lambda r: r.ensure_schema())
+
+    def rebuild_funnel(self):
+        self._fan_out(lambda r: r.rebuild_funnel())
+
+    def close(self):
+        for repo in self.shards:
+            repo.close()
+
+    # --- Escrituras -----------------------------------------------------
+
+    def insert_events(self, opens=(), clicks=()):
+        # Una transacción por shard: si alguno falla, ShardWriteError lleva solo sus filas
+        opens_por_shard = self._group(opens)
+        clicks_por_shard = self._group(clicks)
+        errores, opens_fallidos, clicks_fallidos = [], [], []
+        for i in set(opens_por_shard) | set(clicks_por_shard):
+            opens_shard, clicks_shard = opens_por_shard.get(i, []), clicks_por_shard.get(i, [])
+            try:
+                self.shards[i].insert_events(opens_shard, clicks_shard)
+            except Exception as e:
+                errores.append((self.names[i], e))
+                opens_fallidos.extend(opens_shard)
+                clicks_fallidos.extend(clicks_shard)
+        if errores:
+            raise ShardWriteError(errores, opens_fallidos, clicks_fallidos)
+
+    def ingest_events(self, events):
+        grupos = self._group(events, email_index=3)
+        return list(chain.from_iterable(
+            self._executor.map(lambda i: self.shards[i].ingest_events(grupos[i]), list(grupos))))
+
+    def insert_form(self, nombre, email, institucion, telefono, dia, horario, timestamp, email_id=None):
+        self.for_email(email_id).insert_form(nombre, email, institucion, telefono, dia, horario,
+                                             timestamp, email_id)
+
+    def insert_link(self, token, url):
+        self.home.insert_link(token, url)
+
+    def register_sends(self, rows):
+        for i, filas in self._group(rows).items():
+            self.shards[i].register_sends(filas)
+
+    # --- Lecturas -------------------------------------------------------
+
+    def list_links(self):
+        return self.home.list_links()
+
+    def stats_summary(self):
+        # Cada email_id vive en un solo shard: los distintos se pueden sumar
+        resultados = self._fan_out(lambda r: r.stats_summary())
+        return sum(r[0] for r in resultados), sum(r[1] for r in resultados)
+
+    def list_opens(self):
+        listas = self._fan_out(lambda r: r.list_opens())
+        return list(heapq.merge(*listas, key=lambda row: str(row.timestamp), reverse=True))
+
+    def iter_opens(self, batch_size=5000):
+        return heapq.merge(*(r.iter_opens(batch_size) for r in self.shards),
+                           key=lambda row: str(row[2]), reverse=True)
+
+    def open_counts_by_institucion(self):
+        totales = defaultdict(int)
+        for filas in self._fan_out(lambda r: r.open_counts_by_institucion()):
+            for institucion, n in filas:
+                totales[institucion] += n
+        return list(totales.items())
+
+    def open_counts_since(self, since):
+        totales = defaultdict(int)
+        for filas in self._fan_out(lambda r: r.open_counts_since(since)):
+            for timestamp, n in filas:
+                totales[timestamp] += n
+        return list(totales.items())
+
+    def iter_open_email_ids(self, batch_size=5000):
+        # Cada email_id vive en un solo shard: no hay repetidos entre shards
+        return chain.from_iterable(r.iter_open_email_ids(batch_size) for r in self.shards)
+
+    def funnel_summary(self):
+        partes = self._fan_out(lambda r: r.funnel_summary())
+
+        def promedio(valor, peso):
+            total = sum(getattr(p, peso) for p in partes)
+            if not total:
+                return None
+            return sum(float(getattr(p, valor)) * getattr(p, peso) for p in partes if getattr(p, peso)) / total
+
+        return FunnelSummary(
+            total=sum(p.total for p in partes),
+            enviados=sum(p.enviados for p in partes),
+            abiertos=sum(p.abiertos for p in partes),
+            clicks=sum(p.clicks for p in partes),
+            formularios=sum(p.formularios for p in partes),
+            avg_open=promedio('avg_open', 'n_open'),
+            avg_form=promedio('avg_form', 'n_form'),
+            n_open=sum(p.n_open for p in partes),
+            n_form=sum(p.n_form for p in partes),
+            # Con varios shards la mediana es el promedio ponderado de las medianas (aproximación)
+            median_open=promedio('median_open', 'n_open'),
+            median_form=promedio('median_form', 'n_form'),
+        )
+
+    def funnel_conversions(self, limit=100):
+        listas = self._fan_out(lambda r: r.funnel_conversions(limit))
+        return list(heapq.merge(*listas, key=lambda row: str(row.form_at), reverse=True))[:limit]
+
+    def search(self, texto, limit=20, offset=0):
+        # Los puntajes de relevancia no son comparables entre shards: se piden
+        # los primeros offset+limit de cada uno y se intercalan en orden
+        resultados = self._fan_out(lambda r: r.search(texto, limit=offset + limit, offset=0))
+
+        def intercalar(listas):
+            filas = [fila for grupo in zip_longest(*listas) for fila in grupo if fila is not None]
+            return filas[offset:offset + limit]
+
+        return (intercalar([r[0] for r in resultados]), intercalar([r[1] for r in resultados]))
+
+
+def build_repository(database_url=None, sqlite_path='email_tracking.db'):
+    """ShardedRepository si SHARDS está configurado; si no, un Repository simple"""
+    config = os.environ.get('SHARDS')
+    if not config:
+        return Repository(database_url, sqlite_path=sqlite_path)
+    shards = parse_shards(config)
+    if len(shards) == 1:
+        return shards[0][1]
+    return ShardedRepository(shards)
+
+
+def rebalance(sharded, dry_run=False):
+    """
+    Mueve cada email_id al shard que le corresponde con la configuración
+    actual. Ejecutar con las escrituras pausadas. Es seguro repetirlo si se
+    interrumpe: el destino reemplaza las filas antes de que el origen las borre.
+    """
+    movidos = defaultdict(int)
+    for origen_idx, origen in enumerate(sharded.shards):
+        por_destino = defaultdict(list)
+        for email_id in origen.list_recipient_ids():
+            destino_idx = sharded.shard_index(email_id)
+            if destino_idx != origen_idx:
+                por_destino[destino_idx].append(email_id)
+
+        for destino_idx, email_ids in por_destino.items():
+            ruta = f'{sharded.names[origen_idx]} -> {sharded.names[destino_idx]}'
+            movidos[ruta] += len(email_ids)
+            if dry_run:
+                continue
+            destino = sharded.shards[destino_idx]
+            for i in range(0, len(email_ids), REBALANCE_CHUNK):
+                chunk = email_ids[i:i + REBALANCE_CHUNK]
+                destino.import_recipients(chunk, origen.export_recipients(chunk))
+                origen.delete_recipients(chunk)
+
+    for ruta, n in sorted(movidos.items()):
+        print(f"{'🔎' if dry_run else '🚚'} {ruta}: {n} email_id")
+    if not movidos:
+        print("✅ Los shards ya están balanceados")
+    return dict(movidos)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebalance':
+        print(f"Uso: SHARDS=... {sys.argv[0]} rebalance [--dry-run]")
+        sys.exit(1)
+    repo = build_repository()
+    if not isinstance(repo, ShardedRepository):
+        print("SHARDS debe tener al menos dos shards")
+        sys.exit(1)
+    repo.init_schema()
+    rebalance(repo, dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+IDs de tracking firmados - Alianza ITSEIA-BYS
+Codifica campaña y destinatario (enteros) en un ID compacto, URL-safe y
+firmado con HMAC. La verificación es puro CPU: no consulta la base de datos.
+
+Formato: <payload>.<firma>
+    payload = base64url(version | varint(campaña) | varint(destinatario))
+    firma   = base64url(HMAC-SHA256(secret, payload)[:8])
+
+También acepta los IDs antiguos `institucion_timestamp`. Los IDs firmados no
+llevan la institución (TrackingId.institucion es None): sus aperturas se
+agrupan por campaña/destinatario, no por institución.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import sys
+from collections import namedtuple
+
+from repository import is_production
+
+VERSION = 1
+TAG_SIZE = 8
+MAX_ID_LENGTH = 64
+# Las columnas campaign_id / recipient_id son INTEGER (int4)
+MAX_ID_VALUE = 2**31 - 1
+
+TRACKING_SECRET = os.environ.get('TRACKING_SECRET')
+if not TRACKING_SECRET:
+    # El secreto de desarrollo es público: en producción cualquiera podría firmar IDs
+    if is_production():
+        raise RuntimeError('TRACKING_SECRET es obligatorio en producción (PostgreSQL configurado)')
+    TRACKING_SECRET = 'dev-tracking-secret'
+
+# HMAC con la clave ya procesada; cada verificación solo hace copy()
+_HMAC_BASE = hmac.new(TRACKING_SECRET.encode(), digestmod=hashlib.sha256)
+
+# Formato firmado: la firma de 8 bytes ocupa 11 caracteres base64url
+_SIGNED_RE = re.compile(r'[A-Za-z0-9_-]+\.[A-Za-z0-9_-]{11}')
+
+# Formato antiguo: institucion-con-guiones_timestamp (letras Unicode, sin '.' ni '/')
+_LEGACY_RE = re.compile(r'[\w-]+_\d{9,}')
+
+TrackingId = namedtuple('TrackingId', ['campaign', 'recipient', 'institucion'])
+
+
+class InvalidTrackingId(ValueError):
+    """El ID está mal formado o la firma no es válida"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(payload):
+    mac = _HMAC_BASE.copy()
+    mac.update(payload)
+    return mac.digest()[:TAG_SIZE]
+
+
+def _write_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while pos < len(data):
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            break
+    raise InvalidTrackingId('varint inválido')
+
+
+def encode(campaign, recipient):
+    """Genera el ID firmado para (campaña, destinatario)"""
+    if not (0 <= campaign <= MAX_ID_VALUE and 0 <= recipient <= MAX_ID_VALUE):
+        raise ValueError(f'campaign y recipient deben estar entre 0 y {MAX_ID_VALUE}')
+    payload = bytearray([VERSION])
+    _write_varint(campaign, payload)
+    _write_varint(recipient, payload)
+    payload = bytes(payload)
+    return f'{_b64encode(payload)}.{_b64encode(_sign(payload))}'
+
+
+def decode(email_id):
+    """
+    Valida y decodifica un ID de tracking.
+    Devuelve TrackingId; lanza InvalidTrackingId si es falso o mal formado.
+    """
+    if not isinstance(email_id, str) or not email_id or len(email_id) > MAX_ID_LENGTH:
+        raise InvalidTrackingId('longitud inválida')
+
+    if '.' not in email_id:
+        # Formato antiguo (sin firma)
+        if not _LEGACY_RE.fullmatch(email_id):
+            raise InvalidTrackingId('formato no reconocido')
+        parts = email_id.split('_')
+        return TrackingId(None, None, ' '.join(parts[:-1]).replace('-', ' ').title())
+
+    if not _SIGNED_RE.fullmatch(email_id):
+        raise InvalidTrackingId('formato no reconocido')
+    payload_b64, _, tag_b64 = email_id.partition('.')
+    try:
+        payload = _b64decode(payload_b64)
+        tag = _b64decode(tag_b64)
+    except ValueError:
+        raise InvalidTrackingId('base64 inválido')
+    # Solo la codificación canónica: un ID válido tiene una única forma
+    if _b64encode(payload) != payload_b64 or _b64encode(tag) != tag_b64:
+        raise InvalidTrackingId('base64 no canónico')
+
+    if len(tag) != TAG_SIZE or not hmac.compare_digest(tag, _sign(payload)):
+        raise InvalidTrackingId('firma inválida')
+    if not payload or payload[0] != VERSION:
+        raise InvalidTrackingId('versión desconocida')
+
+    campaign, pos = _read_varint(payload, 1)
+    recipient, pos = _read_varint(payload, pos)
+    if pos != len(payload):
+        raise InvalidTrackingId('bytes sobrantes')
+    if campaign > MAX_ID_VALUE or recipient > MAX_ID_VALUE:
+        raise InvalidTrackingId('campaign o recipient fuera de rango')
+    return TrackingId(campaign, recipient, None)
+
+
+if __name__ == '__main__':
+    # Uso: python tracking_ids.py <campaña> <destinatario>
+    if len(sys.argv) != 3:
+        print(f"Uso: {sys.argv[0]} <campaña> <destinatario>")
+        sys.exit(1)
+    print(encode(int(sys.argv[1]), int(sys.argv[2])))